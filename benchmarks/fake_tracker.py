@@ -0,0 +1,74 @@
+"""Issue tracker for benchmarks
+
+Use as --issue-tracker benchmarks.fake_tracker.FakeTracker (repository root
+must be in PYTHONPATH), or FakeBulkTracker to use bulk methods. Issues are
+read from JSON file, created by gen_repo.generate(), which path is taken
+from $GCR_BENCH_ISSUES. Each request sleeps for $GCR_BENCH_TRACKER_LATENCY
+seconds (default is 0) to simulate network latency.
+"""
+
+import os
+import json
+import time
+import threading
+from typing import Any, Dict, List, Iterator
+
+
+class FakeIssue:
+    def __init__(self, tracker: 'FakeTracker', key: str,
+                 data: Dict[str, Any]) -> None:
+        self.tracker = tracker
+        self.key = key
+        self.description = data['description']
+        self.updated = data['updated']
+        self._subissues = data['subissues']
+        self._critical = data['critical']
+
+    def is_critical(self) -> bool:
+        return self._critical
+
+    def is_fixed(self) -> bool:
+        return False
+
+    def get_subissue_keys(self) -> List[str]:
+        return self._subissues
+
+    def get_subissues(self) -> Iterator['FakeIssue']:
+        return (self.tracker.get_issue(key) for key in self._subissues)
+
+
+class FakeTracker:
+    def __init__(self) -> None:
+        with open(os.environ['GCR_BENCH_ISSUES']) as f:
+            self.issues = json.load(f)
+        self.latency = float(os.environ.get('GCR_BENCH_TRACKER_LATENCY', 0))
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _request(self) -> None:
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_issue(self, key: str) -> FakeIssue:
+        self._request()
+        return FakeIssue(self, key, self.issues[key])
+
+    def get_issue_updated(self, key: str) -> str:
+        self._request()
+        return self.issues[key]['updated']
+
+
+class FakeBulkTracker(FakeTracker):
+    """FakeTracker, implementing bulk methods, each is one request"""
+    def get_issues(self, keys: List[str]) -> List[FakeIssue]:
+        self._request()
+        return [FakeIssue(self, key, self.issues[key]) for key in keys]
+
+    def get_subissues_bulk(self, issues: List[FakeIssue]) -> \
+            Dict[str, List[FakeIssue]]:
+        self._request()
+        return {issue.key: [FakeIssue(self, key, self.issues[key])
+                            for key in issue.get_subissue_keys()]
+                for issue in issues}
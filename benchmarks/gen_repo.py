@@ -0,0 +1,201 @@
+"""Generator of synthetic repositories for benchmarks
+
+Repository has a chain of upstream releases upstream-v0, upstream-v1, ...
+and a downstream branch v0, v1, ... on top of each of them: several versions
+of the same series of commits, like after several rebases. Each commit adds
+a new file, so any version of the series applies to any upstream release.
+"""
+
+import os
+import json
+import random
+import argparse
+import subprocess
+from dataclasses import dataclass, asdict
+from typing import List, Dict, Any
+
+SUBJECT = 'bench: commit {i} of feature {f}'
+RENAMED_SUFFIX = ' (reworded)'
+FEATURES = 10
+EPOCH = 1577836800
+
+
+@dataclass
+class RepoShape:
+    """Parameters of the generated repository
+    @commits: number of commits in each range
+    @ranges: number of ranges (versions of the series)
+    @patch_lines: number of lines added by each commit
+    @equal_share: share of commits, equal to their version in the first range
+    @renamed_share: share of commits, which subjects are changed after the
+                    first range (meta file maps old subjects to the new ones)
+    @ok_share: share of differing commits, marked by "ok:" in meta file
+    @issues: number of issues in fake issue tracker, zero to not use issue
+             tracker
+    @seed: seed of random generator, same seed gives same repository
+    """
+    commits: int = 200
+    ranges: int = 3
+    patch_lines: int = 50
+    equal_share: float = 0.7
+    renamed_share: float = 0.05
+    ok_share: float = 0.5
+    issues: int = 20
+    seed: int = 1
+
+
+def data(text: str) -> bytes:
+    b = text.encode()
+    return b'data %d\n%s\n' % (len(b), b)
+
+
+def commit_cmd(ref: str, mark: int, date: int, message: str) -> bytes:
+    ident = f'Bench Author <bench@example.com> {date} +0000'
+    return f'commit {ref}\nmark :{mark}\nauthor {ident}\n' \
+        f'committer {ident}\n'.encode() + data(message)
+
+
+def file_content(i: int, lines: int, version: int) -> str:
+    """Content of file, added by commit @i of series. Version 0 is the
+    original, other versions differ in one line.
+    """
+    text = [f'line {j} of module {i}: {(i * 7919 + j * 104729) % 9973}\n'
+            for j in range(lines)]
+    if version:
+        text[(i * 31) % lines] = f'line of module {i}, changed in ' \
+            f'v{version}\n'
+    return ''.join(text)
+
+
+def generate(path: str, shape: RepoShape) -> Dict[str, Any]:
+    """Create repository at @path
+
+    Returns dict with keys:
+    ranges: range definitions for git-check-rebase, the newest is the last
+    meta: path to meta file
+    issues: path to JSON file for fake_tracker.FakeTracker or None
+    roots: keys of root issues
+    """
+    rng = random.Random(shape.seed)
+    subprocess.run(['git', 'init', '-q', path], check=True)
+
+    # differs[k][i]: commit i of range k differs from commit i of range 0
+    differs = [[False] * shape.commits] + \
+        [[rng.random() >= shape.equal_share for _ in range(shape.commits)]
+         for _ in range(1, shape.ranges)]
+    renamed = [rng.random() < shape.renamed_share
+               for _ in range(shape.commits)]
+
+    def subject(i: int, k: int) -> str:
+        s = SUBJECT.format(i=i, f=i % FEATURES)
+        return s + RENAMED_SUFFIX if renamed[i] and k > 0 else s
+
+    stream: List[bytes] = []
+    mark = 0
+    date = EPOCH
+    marks: Dict[int, List[int]] = {}
+
+    mark += 1
+    stream.append(commit_cmd('refs/heads/upstream', mark, date,
+                             'upstream: initial commit\n'))
+    stream.append(b'M 100644 inline README\n' + data('Benchmark repo\n'))
+
+    for k in range(shape.ranges):
+        mark += 1
+        date += 60
+        stream.append(commit_cmd('refs/heads/upstream', mark, date,
+                                 f'upstream: release {k}\n'))
+        stream.append(b'M 100644 inline upstream.txt\n' +
+                      data(f'release {k}\n'))
+        stream.append(f'reset refs/tags/upstream-v{k}\n'
+                      f'from :{mark}\n\n'.encode())
+        upstream_mark = mark
+
+        marks[k] = []
+        for i in range(shape.commits):
+            mark += 1
+            date += 60
+            stream.append(commit_cmd(
+                f'refs/heads/v{k}', mark, date,
+                f'{subject(i, k)}\n\nBody of commit {i}.\n\n'
+                'Signed-off-by: Bench Author <bench@example.com>\n'))
+            if i == 0:
+                stream.append(f'from :{upstream_mark}\n'.encode())
+            version = k if differs[k][i] else 0
+            stream.append(f'M 100644 inline src/mod{i}.c\n'.encode() +
+                          data(file_content(i, shape.patch_lines, version)))
+            marks[k].append(mark)
+
+    marks_file = os.path.join(path, '.git', 'bench-marks')
+    subprocess.run(['git', 'fast-import', '--quiet',
+                    f'--export-marks={marks_file}'],
+                   input=b''.join(stream), cwd=path, check=True)
+    with open(marks_file) as f:
+        hashes = dict(line.split() for line in f)
+
+    def commit_hash(k: int, i: int) -> str:
+        return hashes[f':{marks[k][i]}'][:12]
+
+    last = shape.ranges - 1
+    meta = []
+    for i in range(shape.commits):
+        lines = []
+        if renamed[i] and last > 0:
+            lines.append('=' + subject(i, 0))
+        for k in range(1, shape.ranges):
+            if differs[k][i] and rng.random() < shape.ok_share:
+                lines.append(f'  ok: {commit_hash(0, i)} {commit_hash(k, i)}')
+        if lines:
+            meta.append(subject(i, last))
+            meta.extend(lines)
+            meta.append('')
+
+    meta_path = os.path.join(path, '.git', 'bench-meta')
+    with open(meta_path, 'w') as f:
+        f.write('\n'.join(meta))
+
+    res: Dict[str, Any] = {
+        'ranges': [f'upstream-v{k}..v{k}' for k in range(shape.ranges)],
+        'meta': meta_path,
+        'issues': None,
+        'roots': [],
+    }
+
+    if shape.issues:
+        # Issues form a tree with four subissues per issue, each issue
+        # mentions several commits of the last range
+        issues = {}
+        for n in range(1, shape.issues + 1):
+            mentioned = rng.sample(range(shape.commits),
+                                   min(3, shape.commits))
+            issues[f'BENCH-{n}'] = {
+                'description': ''.join(f'Port: {subject(i, last)}\n'
+                                       for i in mentioned),
+                'subissues': [f'BENCH-{c}' for c in range(4 * n - 2, 4 * n + 2)
+                              if c <= shape.issues],
+                'updated': f'2020-01-01T00:00:{n % 60:02}',
+                'critical': rng.random() < 0.1,
+            }
+        res['issues'] = os.path.join(path, '.git', 'bench-issues.json')
+        res['roots'] = ['BENCH-1']
+        with open(res['issues'], 'w') as f:
+            json.dump(issues, f)
+
+    return res
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(
+        description='Generate repository for git-check-rebase benchmarks')
+    p.add_argument('path', help='where to create repository')
+    for name, value in asdict(RepoShape()).items():
+        p.add_argument('--' + name.replace('_', '-'), type=type(value),
+                       default=value)
+    args = vars(p.parse_args())
+    path = args.pop('path')
+
+    print(json.dumps(generate(path, RepoShape(**args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
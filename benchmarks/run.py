@@ -0,0 +1,318 @@
+"""Benchmarks of git-check-rebase
+
+Generates a repository by gen_repo.py, then measures the end-to-end run of
+git-check-rebase script and its separate stages, with cold (empty) and warm
+caches. Results are printed as JSON to stdout or to --output file, summary
+is printed to stderr.
+
+Stages are measured in a separate process for each run, so that in-process
+caches of one run don't affect another.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import shlex
+from contextlib import contextmanager
+from dataclasses import asdict
+from tempfile import mkdtemp
+from typing import Any, Dict, List, Iterator
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'git-check-rebase')
+TRACKER = 'benchmarks.fake_tracker.FakeTracker'
+CACHE_STATES = ('cold', 'warm')
+
+# Startup budget: time of "git-check-rebase --help" in a fresh process,
+# not counting the interpreter start (about 0.045s now, the rest is a margin
+# for noisy machines). It is checked by every run.
+STARTUP_BUDGET = 0.075
+# Modules, which must not be imported on startup: everything, which is not
+# needed to parse arguments
+LAZY_MODULES = ('tabulate', 'termcolor', 'jira', 'sqlite3',
+                'concurrent.futures', 'git_check_rebase.compare_ranges',
+                'git_check_rebase.compare_commits',
+                'git_check_rebase.rewrite_commit',
+                'git_check_rebase.issue_cache', 'git_check_rebase.similarity',
+                'git_check_rebase.parse_issues', 'git_check_rebase.gcr_jira')
+
+# Started by "python -c" with script name and output file as arguments, so
+# that nothing but the script is imported in the measured interval
+STARTUP_CODE = '''\
+import sys, time
+start = time.perf_counter()
+script, output = sys.argv[1:]
+sys.argv = [script, '--help']
+try:
+    import runpy
+    runpy.run_path(script, run_name='__main__')
+except SystemExit:
+    pass
+seconds = time.perf_counter() - start
+import json
+with open(output, 'w') as f:
+    json.dump({'seconds': seconds, 'modules': sorted(sys.modules)}, f)
+'''
+
+sys.path.insert(0, ROOT)
+
+from benchmarks.gen_repo import RepoShape, generate  # noqa: E402
+
+
+@contextmanager
+def stage(timings: Dict[str, Dict[str, float]], name: str) -> Iterator[None]:
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    yield
+    timings[name] = {'wall': time.perf_counter() - wall,
+                     'cpu': time.process_time() - cpu}
+
+
+def run_stages(info: Dict[str, Any], jobs: int) -> \
+        Dict[str, Dict[str, float]]:
+    """Run stages of git-check-rebase like its main() does, in current
+    directory. Returns {stage => {'wall': seconds, 'cpu': seconds}}, CPU time
+    doesn't include git subprocesses.
+    """
+    timings: Dict[str, Dict[str, float]] = {}
+
+    with stage(timings, 'import'):
+        # pylint: disable=import-outside-toplevel
+        from git_check_rebase.check_rebase_meta import Meta
+        from git_check_rebase.compare_ranges import MultiRange, Table, Column
+        from git_check_rebase.text_table_view import TextViewer
+
+    with stage(timings, 'meta'):
+        meta = Meta(info['meta'])
+
+    with stage(timings, 'parse_ranges'):
+        last = MultiRange(info['ranges'][-1], meta=meta)
+        ranges = [MultiRange(r, meta=meta, default_base=last.base)
+                  for r in info['ranges'][:-1]] + [last]
+
+    with stage(timings, 'table'):
+        tab = Table(ranges, meta)
+
+    with stage(timings, 'do_comparison'):
+        tab.do_comparison(False, jobs)
+
+    if info['issues']:
+        with stage(timings, 'porting_issues'):
+            tab.add_porting_issues(TRACKER, info['roots'], jobs,
+                                   cache_ttl=3600)
+
+    with stage(timings, 'render'):
+        out = tab.to_list(columns=[Column.COMMITS, Column.SUBJECT])
+        TextViewer(False).view_table(out)
+
+    return timings
+
+
+def bench_env(info: Dict[str, Any], cache_dir: str,
+              latency: float) -> Dict[str, str]:
+    env = dict(os.environ, GIT_CHECK_REBASE_CACHE_DIR=cache_dir,
+               GCR_BENCH_TRACKER_LATENCY=str(latency),
+               PYTHONPATH=os.pathsep.join(
+                   p for p in (ROOT, os.environ.get('PYTHONPATH')) if p))
+    if info['issues']:
+        env['GCR_BENCH_ISSUES'] = info['issues']
+    return env
+
+
+def run_cli(repo: str, info: Dict[str, Any], env: Dict[str, str],
+            jobs: int) -> float:
+    cmd = [sys.executable, SCRIPT, '--meta', info['meta'], '--no-color',
+           '--jobs', str(jobs)]
+    if info['issues']:
+        cmd += ['--issue-tracker', TRACKER,
+                '--porting-issues', ','.join(info['roots'])]
+    cmd += info['ranges']
+
+    start = time.perf_counter()
+    subprocess.run(cmd, cwd=repo, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def run_worker(repo: str, info: Dict[str, Any], env: Dict[str, str],
+               jobs: int) -> Dict[str, Dict[str, float]]:
+    out = subprocess.run([sys.executable, os.path.abspath(__file__),
+                          '--worker', json.dumps(info), str(jobs)],
+                         cwd=repo, env=env, check=True,
+                         stdout=subprocess.PIPE, encoding='utf-8').stdout
+    return json.loads(out)
+
+
+def startup(repeat: int, workdir: str) -> Dict[str, Any]:
+    """Measure startup of the script by --help runs
+
+    git in PATH is replaced by a stub, which leaves a mark if called.
+    """
+    bindir = os.path.join(workdir, 'bin')
+    mark = os.path.join(workdir, 'git-called')
+    output = os.path.join(workdir, 'startup.json')
+    os.makedirs(bindir, exist_ok=True)
+    stub = os.path.join(bindir, 'git')
+    with open(stub, 'w') as f:
+        f.write(f'#!/bin/sh\ntouch {shlex.quote(mark)}\nexit 1\n')
+    os.chmod(stub, 0o755)
+
+    env = dict(os.environ, PATH=os.pathsep.join((bindir, os.environ['PATH'])),
+               PYTHONPATH=os.pathsep.join(
+                   p for p in (ROOT, os.environ.get('PYTHONPATH')) if p))
+    wall = []
+    modules = set()
+    for _ in range(repeat):
+        subprocess.run([sys.executable, '-c', STARTUP_CODE, SCRIPT, output],
+                       env=env, check=True, stdout=subprocess.DEVNULL)
+        with open(output) as f:
+            res = json.load(f)
+        wall.append(res['seconds'])
+        modules.update(m for m in LAZY_MODULES if m in res['modules'])
+
+    return {'wall': wall, 'lazy_modules_imported': sorted(modules),
+            'git_called': os.path.exists(mark)}
+
+
+def check_startup(res: Dict[str, Any], budget: float) -> List[str]:
+    """Returns list of violations of startup budget"""
+    problems = []
+    median = statistics.median(res['wall'])
+    if median > budget:
+        problems.append(f'startup takes {median:.3f}s, budget is '
+                        f'{budget:.3f}s')
+    if res['lazy_modules_imported']:
+        problems.append('modules imported on startup: ' +
+                        ', '.join(res['lazy_modules_imported']))
+    if res['git_called']:
+        problems.append('git is called on startup')
+    return problems
+
+
+def benchmark(shape: RepoShape, repeat: int, jobs: int, latency: float,
+              workdir: str) -> Dict[str, Any]:
+    repo = os.path.join(workdir, 'repo')
+    cache_dir = os.path.join(workdir, 'cache')
+
+    start = time.perf_counter()
+    info = generate(repo, shape)
+    generate_time = time.perf_counter() - start
+
+    env = bench_env(info, cache_dir, latency)
+    results: Dict[str, Any] = {state: {'cli': {'wall': []}, 'stages': {}}
+                               for state in CACHE_STATES}
+
+    for _ in range(repeat):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        for state in CACHE_STATES:
+            results[state]['cli']['wall'].append(
+                run_cli(repo, info, env, jobs))
+
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        for state in CACHE_STATES:
+            timings = run_worker(repo, info, env, jobs)
+            for name, t in timings.items():
+                res = results[state]['stages'].setdefault(
+                    name, {'wall': [], 'cpu': []})
+                res['wall'].append(t['wall'])
+                res['cpu'].append(t['cpu'])
+
+    git_version = subprocess.run(['git', '--version'], check=True,
+                                 stdout=subprocess.PIPE,
+                                 encoding='utf-8').stdout.strip()
+    return {
+        'params': dict(asdict(shape), repeat=repeat, jobs=jobs,
+                       tracker_latency=latency),
+        'environment': {'python': platform.python_version(),
+                        'git': git_version,
+                        'platform': platform.platform()},
+        'generate': generate_time,
+        'results': results,
+    }
+
+
+def print_summary(res: Dict[str, Any]) -> None:
+    def fmt(times: List[float]) -> str:
+        return f'{statistics.median(times):9.3f}'
+
+    print(f'{"":24}' + ''.join(f'{s:>10}' for s in CACHE_STATES),
+          file=sys.stderr)
+    results = res['results']
+    print(f'{"cli":24}' + ''.join(fmt(results[s]['cli']['wall']) + ' '
+                                  for s in CACHE_STATES), file=sys.stderr)
+    for name in results['cold']['stages']:
+        print(f'{name:24}' + ''.join(
+            fmt(results[s]['stages'][name]['wall']) + ' '
+            for s in CACHE_STATES), file=sys.stderr)
+    print('(median wall time, seconds)', file=sys.stderr)
+
+
+def main() -> None:
+    if len(sys.argv) == 4 and sys.argv[1] == '--worker':
+        json.dump(run_stages(json.loads(sys.argv[2]), int(sys.argv[3])),
+                  sys.stdout)
+        return
+
+    p = argparse.ArgumentParser(description='Run git-check-rebase benchmarks')
+    for name, value in asdict(RepoShape()).items():
+        p.add_argument('--' + name.replace('_', '-'), type=type(value),
+                       default=value, help=f'repository shape, default is '
+                       f'{value}. See gen_repo.RepoShape')
+    p.add_argument('--repeat', type=int, default=3,
+                   help='number of runs of each benchmark, default is 3')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help='--jobs of git-check-rebase, default is 1')
+    p.add_argument('--tracker-latency', type=float, default=0,
+                   metavar='SECONDS',
+                   help='delay of each request to fake issue tracker')
+    p.add_argument('--startup-budget', type=float,
+                   default=STARTUP_BUDGET * 1000, metavar='MS',
+                   help='fail if median startup time (git-check-rebase '
+                   f'--help) exceeds MS milliseconds, default is '
+                   f'{STARTUP_BUDGET * 1000:.0f}')
+    p.add_argument('--startup-only', action='store_true',
+                   help='only check startup, don\'t generate repository')
+    p.add_argument('--output', help='write JSON results to file instead of '
+                   'stdout')
+    p.add_argument('--keep', metavar='DIR', help='generate repository in '
+                   'DIR and keep it, by default temporary directory is used')
+    args = vars(p.parse_args())
+
+    opts = {k: args.pop(k) for k in ('repeat', 'jobs', 'tracker_latency',
+                                     'output', 'keep', 'startup_budget',
+                                     'startup_only')}
+    workdir = opts['keep'] or mkdtemp(prefix='gcr-bench-')
+    try:
+        res = {} if opts['startup_only'] else \
+            benchmark(RepoShape(**args), opts['repeat'], opts['jobs'],
+                      opts['tracker_latency'], workdir)
+        res['startup'] = startup(max(opts['repeat'], 5), workdir)
+    finally:
+        if not opts['keep']:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if 'results' in res:
+        print_summary(res)
+    print(f'{"startup":24}'
+          f'{statistics.median(res["startup"]["wall"]):9.3f}',
+          file=sys.stderr)
+    if opts['output']:
+        with open(opts['output'], 'w') as f:
+            json.dump(res, f, indent=2)
+    else:
+        json.dump(res, sys.stdout, indent=2)
+        print()
+
+    problems = check_startup(res['startup'], opts['startup_budget'] / 1000)
+    if problems:
+        sys.exit('Startup budget exceeded: ' + '; '.join(problems))
+
+
+if __name__ == '__main__':
+    main()
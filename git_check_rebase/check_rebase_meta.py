@@ -1,5 +1,18 @@
+import io
 import re
-from typing import Optional, Tuple
+import os
+import time
+import json
+import shutil
+import hashlib
+from tempfile import mkstemp
+from typing import Optional, Tuple, List, Any
+
+from .simple_git import git_get_cache_dir
+from .stats import STATS
+
+# Bump when parsed classes change in incompatible way
+SNAPSHOT_VERSION = 3
 
 drop_jira_issue_regex = re.compile(r'(\s*#[A-Z]{3,5}-\d{3,6})+$')
 
@@ -85,6 +98,19 @@ class CommitMeta(Feature):
     def add_checked_pair(self, h1, h2):
         self.checked.append((h1, h2))
 
+    def to_list(self) -> List[Any]:
+        """Compact representation for snapshot, see from_list()"""
+        return [self.subject, self.comment, self.checked, self.feature,
+                self.drop, self.upstreaming]
+
+    @classmethod
+    def from_list(cls, data: List[Any]) -> 'CommitMeta':
+        commit = cls(data[0])
+        commit.comment, checked, commit.feature, commit.drop, \
+            commit.upstreaming = data[1:]
+        commit.checked = [tuple(pair) for pair in checked]
+        return commit
+
     def add_property(self, prop):
         if prop.startswith('drop') or prop.startswith('upstreaming'):
             super().add_property(prop)
@@ -96,9 +122,13 @@ class CommitMeta(Feature):
             self.add_comment_line(prop)
 
 
-def meta_file_set_comment(fname: str, subject: str, comment: str,
-                          ok_pair: Optional[Tuple[str, str]] = None) -> None:
-    """ Set commit comment and add new ok_pair (old ok pairs remains) """
+def meta_lines_set_comment(lines: List[str], subject: str, comment: str,
+                           ok_pair: Optional[Tuple[str, str]] = None) -> \
+        List[str]:
+    """ Set commit comment and add new ok_pair (old ok pairs remains)
+    @lines: lines of meta file, with line endings
+    Returns new list of lines
+    """
 
     if comment:
         assert comment.strip()
@@ -112,97 +142,216 @@ def meta_file_set_comment(fname: str, subject: str, comment: str,
     if ok_pair:
         insert_lines.append(f'  ok: {ok_pair[0]} {ok_pair[1]}\n')
 
-    lines = []
+    out = []
     cur_subj = None
-    with open(fname) as f:
-        found = False
+    found = False
 
-        for line in f:
+    for line in lines:
+        if cur_subj == subject:
+            if line[0:2] == '  ':
+                # Skip old comment
+                continue
+
+        out.append(line)
+        line = line.rstrip()
+
+        if line and line[0] not in '# =' and line[-1] != ':':
+            cur_subj = line.rstrip()
             if cur_subj == subject:
-                if line[0:2] == '  ':
-                    # Skip old comment
-                    continue
+                found = True
+                out += insert_lines
 
-            lines.append(line)
-            line = line.rstrip()
+    if not found and insert_lines:
+        out.append(f'\n{subject}\n')
+        out += insert_lines
 
-            if line and line[0] not in '# =' and line[-1] != ':':
-                cur_subj = line.rstrip()
-                if cur_subj == subject:
-                    found = True
-                    lines += insert_lines
+    return out
 
-        if not found and insert_lines:
-            lines.append(f'\n{subject}\n')
-            lines += insert_lines
 
-    with open(fname, 'w') as f:
-        f.write(''.join(lines))
+def write_file_atomic(fname: str, text: str) -> None:
+    """Write file through temporary file and rename, so that the file is
+    never seen partly written"""
+    fname = os.path.realpath(fname)
+    fd, tmp = mkstemp(dir=os.path.dirname(fname),
+                      prefix='.' + os.path.basename(fname))
+    try:
+        with open(fd, 'w') as f:
+            f.write(text)
+        shutil.copymode(fname, tmp)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.unlink(tmp)
+        raise
 
 
 class Meta:
+    """Parsed meta file
+
+    Updates are applied to the parsed data at once, and written to disk in
+    batches: after @flush_every updates, when @flush_interval seconds passed
+    since last write, or by explicit flush() call.
+    """
+    flush_every = 20
+    flush_interval = 60
+
     def __init__(self, fname):
         self.fname = fname
+        self._stat = self._file_stat()
+        self._pending: List[Tuple[str, str,
+                                  Optional[Tuple[str, str]]]] = []
+        self._flushed_at = time.monotonic()
+
+        loaded = self._load_snapshot()
+        STATS.cache_lookup('meta_snapshot', loaded)
+        if not loaded:
+            self._parse()
+            self._save_snapshot()
+
+        for _ in range(self._deprecated_tags):
+            print('"tag:" syntax is deprecated. '
+                  'Use "%feature: <tag> <commits> %end" for '
+                  'grouping by features, "%drop: <tag> <commits> %end"'
+                  ' for drop grouping.')
+
+    def _snapshot_path(self) -> str:
+        key = hashlib.sha1(os.path.realpath(self.fname).encode()).hexdigest()
+        return os.path.join(git_get_cache_dir(), 'meta-snapshots',
+                            key + '.json')
+
+    def _load_snapshot(self) -> bool:
+        """Restore parsed state from the snapshot if file is unchanged
+
+        Snapshot is trusted if file mtime and size are the same, otherwise
+        it is still used if content hash matches (file was touched or
+        rewritten with the same content). Like git does for the index, we
+        don't trust the stat of a file modified not before the snapshot was
+        written: it may be modified again within the same timestamp tick.
+        """
+        if self._stat[1] == 0:
+            # Empty file: nothing to parse, don't litter the cache
+            return False
+
+        try:
+            with open(self._snapshot_path(), 'rb') as f:
+                snapshot_mtime = os.fstat(f.fileno()).st_mtime_ns
+                snapshot = json.load(f)
+            assert snapshot['version'] == SNAPSHOT_VERSION
+            by_key = {}
+            for key, *data in snapshot['commits']:
+                commit = CommitMeta.from_list(data)
+                by_key[commit.subject if key is None else key] = commit
+        except Exception:
+            # No snapshot, or it's broken, or created by other version
+            return False
+
+        if tuple(snapshot['stat']) != self._stat or \
+                self._stat[0] >= snapshot_mtime:
+            with open(self.fname, 'rb') as f:
+                content = f.read()
+            if hashlib.sha1(content).hexdigest() != snapshot['hash']:
+                return False
+            snapshot['stat'] = self._stat
+            self._write_snapshot(snapshot)
+
+        self.by_key = by_key
+        self.aliases = snapshot['aliases']
+        self._deprecated_tags = snapshot['deprecated_tags']
+        return True
+
+    def _save_snapshot(self) -> None:
+        # Only parsed data is saved, not lines of the file: they are needed
+        # only to write updates, and flush() reads the file anyway
+        if self._stat[1] == 0:
+            return
+
+        self._write_snapshot({
+            'version': SNAPSHOT_VERSION,
+            'stat': self._stat,
+            'hash': self._hash,
+            # Key is usually same as subject, don't store it twice
+            'commits': [[None if key == commit.subject else key,
+                         *commit.to_list()]
+                        for key, commit in self.by_key.items()],
+            'aliases': self.aliases,
+            'deprecated_tags': self._deprecated_tags,
+        })
+
+    def _write_snapshot(self, snapshot) -> None:
+        path = self._snapshot_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, path)
+        except OSError:
+            # Snapshot is only an optimization
+            pass
+
+    def _parse(self) -> None:
         self.by_key = {}
         self.aliases = {}
+        self._deprecated_tags = 0
 
         groups_stack = []
         current_obj = None
 
-        with open(fname) as f:
-            for line in f:
-                line = line.rstrip()
-
-                if not line or line[0] == '#':
-                    continue
+        # Snapshot is checked by hash of raw file content, not of decoded
+        # text, which has line endings translated
+        with open(self.fname, 'rb') as f:
+            content = f.read()
+        self._hash = hashlib.sha1(content).hexdigest()
 
-                if line[0:2] == '  ':
-                    current_obj.add_property(line[2:])
+        for line in io.TextIOWrapper(io.BytesIO(content)):
+            line = line.rstrip()
 
-                elif line[0] == '=':
-                    assert isinstance(current_obj, CommitMeta)
-                    self.aliases[subject_to_key(line[1:])] = \
-                        subject_to_key(current_obj.subject)
+            if not line or line[0] == '#':
+                continue
+
+            if line[0:2] == '  ':
+                current_obj.add_property(line[2:])
+
+            elif line[0] == '=':
+                assert isinstance(current_obj, CommitMeta)
+                self.aliases[subject_to_key(line[1:])] = \
+                    subject_to_key(current_obj.subject)
+
+            elif line[-1] == ':':
+                self._deprecated_tags += 1
+                # Addition properties are not allowed for deprecated tag
+                current_obj = None
+                # Mimic old behavior: tag clears previous tag
+                if line.startswith('drop'):
+                    reason = line[4:-1]
+                    if reason and reason[0] == '-':
+                        reason = reason[1:]
+                    groups_stack = [DropGroup(reason)]
+                else:
+                    groups_stack = [Feature(line[:-1])]
 
-                elif line[-1] == ':':
-                    print('"tag:" syntax is deprecated. '
-                          'Use "%feature: <tag> <commits> %end" for '
-                          'grouping by features, "%drop: <tag> <commits> %end"'
-                          ' for drop grouping.')
-                    # Addition properties are not allowed for deprecated tag
+            elif line[0] == '%':
+                if line == '%end':
                     current_obj = None
-                    # Mimic old behavior: tag clears previous tag
-                    if line.startswith('drop'):
-                        reason = line[4:-1]
-                        if reason and reason[0] == '-':
-                            reason = reason[1:]
-                        groups_stack = [DropGroup(reason)]
-                    else:
-                        groups_stack = [Feature(line[:-1])]
-
-                elif line[0] == '%':
-                    if line == '%end':
-                        current_obj = None
-                        del groups_stack[-1]
+                    del groups_stack[-1]
+                else:
+                    key, val = [x.strip() for x in line.split(':', 2)]
+                    if key == '%feature':
+                        current_obj = Feature(val)
                     else:
-                        key, val = [x.strip() for x in line.split(':', 2)]
-                        if key == '%feature':
-                            current_obj = Feature(val)
-                        else:
-                            assert key == '%drop'
-                            current_obj = DropGroup(val)
-                        groups_stack.append(current_obj)
+                        assert key == '%drop'
+                        current_obj = DropGroup(val)
+                    groups_stack.append(current_obj)
 
+            else:
+                # Normal commit
+                key = subject_to_key(line)
+                if key in self.by_key:
+                    current_obj = self.by_key[key]
                 else:
-                    # Normal commit
-                    key = subject_to_key(line)
-                    if key in self.by_key:
-                        current_obj = self.by_key[key]
-                    else:
-                        current_obj = CommitMeta(line)
-                        self.by_key[key] = current_obj
-                    if groups_stack:
-                        current_obj.add_group(groups_stack[-1])
+                    current_obj = CommitMeta(line)
+                    self.by_key[key] = current_obj
+                if groups_stack:
+                    current_obj.add_group(groups_stack[-1])
 
     def alias_to_key(self, alias):
         return self.aliases.get(alias, alias)
@@ -238,4 +387,31 @@ class Meta:
         if ok_pair is not None:
             commit.add_checked_pair(*ok_pair)
 
-        meta_file_set_comment(self.fname, commit.subject, comment, ok_pair)
+        self._pending.append((commit.subject, comment, ok_pair))
+
+        if len(self._pending) >= self.flush_every or \
+                time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def _file_stat(self) -> Tuple[int, int, int, int]:
+        st = os.stat(self.fname)
+        return st.st_mtime_ns, st.st_size, st.st_ino, st.st_ctime_ns
+
+    def flush(self) -> None:
+        """Write not yet saved updates to the file
+
+        Updates are applied to the current content of the file, so that
+        modifications, done by someone else since the file was parsed, are
+        not lost.
+        """
+        if not self._pending:
+            return
+
+        with open(self.fname) as f:
+            lines = f.readlines()
+        for update in self._pending:
+            lines = meta_lines_set_comment(lines, *update)
+
+        write_file_atomic(self.fname, ''.join(lines))
+        self._pending.clear()
+        self._flushed_at = time.monotonic()
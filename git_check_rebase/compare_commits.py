@@ -1,38 +1,162 @@
 import re
 import os
+import sys
+import json
+import time
+import zlib
+import atexit
+import functools
+import sqlite3
+import shutil
+import hashlib
 import subprocess
 from enum import Enum
 from dataclasses import dataclass
-from typing import Optional, List, Tuple
-from tempfile import mkstemp
+from typing import Optional, List, Tuple, Dict, Iterable, Iterator, \
+    AnyStr, Union
+from tempfile import mkstemp, mkdtemp
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from .simple_git import git, git_get_git_dir, git_get_cache_dir, \
+    git_stream, git_stream_pieces, git_rev_parse, git_is_ancestor, \
+    git_log_records
+from .rewrite_commit import rewrite_commit, RewriteError
+from .stats import STATS
+
+# Rules of eat_numbers(): (name, regex, replacement). Regexes are matched
+# at line starts, "from" rule only at the start of the patch. At most one
+# rule matches any line.
+EAT_NUMBERS_RULES = (
+    ('from', 'From .*', 'From <from line>'),
+    ('index', 'index .*', 'index <some index>'),
+    ('commit', 'commit .*', 'commit <some commit>'),
+    ('date', 'Date:.*00', 'Date: <some date>'),
+    ('hunk', '@@ .* @@', '@@ <some lines> @@'),
+)
+
+# Rule to drop added or removed empty lines
+EMPTY_LINE_CHANGE_RULE = ('empty', '[+-](?=\n)', '')
+
+
+@functools.lru_cache(maxsize=None)
+def eat_numbers_regex(ignore_empty_lines: bool, binary: bool) -> \
+        Tuple[re.Pattern, Dict[str, Union[str, bytes]]]:
+    """Compile all the rules to one regex for str or (if @binary) bytes
+
+    Regex matches newline before the line, as search for a constant prefix
+    is much faster than for ^ in multiline mode. Replacements include this
+    newline, besides the one of "empty" rule, which drops the line.
+
+    Returns regex and dict {rule name => replacement}
+    """
+    rules = EAT_NUMBERS_RULES
+    if ignore_empty_lines:
+        rules += (EMPTY_LINE_CHANGE_RULE,)
 
-from .simple_git import git, git_get_git_dir, git_log1, git_log
+    def conv(s: str) -> Union[str, bytes]:
+        return s.encode() if binary else s
 
-eat_numbers_subs = tuple((re.compile(a, re.MULTILINE), b) for a, b in
-                         (
-                             (r'\AFrom .*', 'From <from line>'),
-                             (r'^index .*', 'index <some index>'),
-                             (r'^commit .*', 'commit <some commit>'),
-                             (r'^Date:.*00', 'Date: <some date>'),
-                             (r'^@@ .* @@', '@@ <some lines> @@'),
-                         ))
+    regex = '\n(?:' + \
+        '|'.join(f'(?P<{name}>{r})' for name, r, _ in rules) + ')'
+    return re.compile(conv(regex)), \
+        {name: conv('\n' + repl if repl else '') for name, _, repl in rules}
 
-empty_line_changes_subs = tuple((re.compile(a, re.MULTILINE), b) for a, b in
-                                (
-                                    (r'^\+\n', ''),
-                                    (r'^\-\n', ''),
-                                ))
 
+def iter_eat_numbers(patch: str, ignore_empty_lines: bool = True) -> \
+        Iterator[str]:
+    """Yield pieces of @patch, which being joined give eat_numbers(@patch)
 
-def eat_numbers(patch, ignore_empty_lines=True):
-    for e in eat_numbers_subs:
-        patch = e[0].sub(e[1], patch)
+    The patch is scanned once. See PatchHasher for bytes.
+    """
+    regex, replacements = eat_numbers_regex(ignore_empty_lines, False)
+    # Newline is prepended, so that the first line is matched as others.
+    # Result always starts with this newline (if it is dropped by "empty"
+    # rule, the line end of the dropped line takes its place), so the first
+    # character of the result is skipped.
+    yield from _skip_first(
+        _iter_eat_numbers('\n' + patch, regex, replacements))
+
+
+def _skip_first(pieces: Iterator[AnyStr]) -> Iterator[AnyStr]:
+    for piece in pieces:
+        if piece:
+            yield piece[1:]
+            break
+    yield from pieces
+
+
+def _iter_eat_numbers(patch, regex, replacements, end=None, at_start=True):
+    """Yield pieces of filtered @patch[:@end]
+
+    Matches are searched up to @end inclusive, so that lookahead of "empty"
+    rule sees newline at @end. "from" rule is applied only if @patch is
+    @at_start of the whole patch.
+    """
+    if end is None:
+        end = len(patch)
+    pos = 0
+    for m in regex.finditer(patch, 0, end + 1):
+        if m.lastgroup == 'from' and (m.start() != 0 or not at_start):
+            continue
+        yield patch[pos:m.start()]
+        yield replacements[m.lastgroup]
+        pos = m.end()
+    yield patch[pos:end]
+
+
+class PatchHasher:
+    """Same as text_hash(eat_numbers(patch)) for UTF-8 encoded patch, given
+    by chunks
+
+    Interface is like of hashlib objects. Each chunk is filtered and hashed
+    by complete lines as soon as it comes, so neither the patch nor the
+    filtered patch is ever built.
+    """
+    def __init__(self) -> None:
+        self._regex, self._replacements = eat_numbers_regex(True, True)
+        self._hash = hashlib.sha1()
+        # Not yet hashed data, starts with newline before the first not
+        # hashed line (for the first line of the patch the newline is
+        # prepended, like in iter_eat_numbers())
+        self._tail = b'\n'
+        self._at_start = True
+        # Is first character of the result not yet skipped
+        self._skip = True
+
+    def update(self, chunk: bytes) -> None:
+        buf = self._tail + chunk
+        end = buf.rfind(b'\n')
+        if end == 0:
+            self._tail = buf
+            return
+
+        self._skip = self._hash_lines(self._hash, buf, end)
+        self._tail = buf[end:]
+        self._at_start = False
+
+    def _hash_lines(self, h, buf: bytes, end: int) -> bool:
+        """Filter lines of @buf up to @end and add them to @h
+
+        Returns new value of _skip
+        """
+        skip = self._skip
+        for piece in _iter_eat_numbers(memoryview(buf), self._regex,
+                                       self._replacements, end,
+                                       self._at_start):
+            if skip and piece:
+                piece = piece[1:]
+                skip = False
+            h.update(piece)
+        return skip
+
+    def hexdigest(self) -> str:
+        h = self._hash.copy()
+        self._hash_lines(h, self._tail, len(self._tail))
+        return h.hexdigest()
 
-    if ignore_empty_lines:
-        for e in empty_line_changes_subs:
-            patch = e[0].sub(e[1], patch)
 
-    return patch
+def eat_numbers(patch, ignore_empty_lines=True):
+    return ''.join(iter_eat_numbers(patch, ignore_empty_lines))
 
 
 def sorted_pair(a: str, b: str) -> Tuple[str, str]:
@@ -45,34 +169,518 @@ class IsEqual(Enum):
     FULL_EQUAL = 3  # commits are equal as well as commit messages
 
 
+@dataclass(frozen=True)
+class Fingerprint:
+    """Commit reduced to hashes of its normalized patch and its message"""
+    patch: str
+    message: str
+
+
 class EqualityCache:
+    """Persistent storage of commit comparison results
+
+    Results are stored in sqlite database, keyed by pair of full commit
+    ids. Lookups don't load the whole database, new results are written
+    in batches of @batch_size (and on exit).
+
+    Commit fingerprints are stored too, keyed by full commit id, and
+    parsed logs of commit ranges, keyed by full ids of base and top.
+
+    The database is used in WAL mode, so several processes (parallel CI
+    jobs, worktrees, clones sharing the cache directory) may read and
+    write it simultaneously. Writer waits up to @timeout seconds for
+    another writer to finish.
+    """
+    batch_size = 1000
+    timeout = 60
+
     def __init__(self, fname: str) -> None:
-        self._dict = {}
         self.fname = fname
+        self._full_ids: Dict[str, Optional[str]] = {}
+        self._pending: Dict[Tuple[str, str], IsEqual] = {}
+        self._pending_fps: Dict[str, Fingerprint] = {}
 
         try:
-            with open(fname) as f:
-                for line in f:
-                    h1, h2, result = line.strip().split(' ', 2)
-                    self._dict[sorted_pair(h1, h2)] = IsEqual[result]
-        except FileNotFoundError:
-            pass
-        except (KeyError, ValueError):
-            # Most probably old format detected
-            os.unlink(fname)
+            self._db = self._connect(fname)
+        except sqlite3.DatabaseError as e:
+            # Don't drop the file: it is shared with other processes
+            print(f'Failed to open cache {fname}: {e}. '
+                  'Comparison results will not be saved.', file=sys.stderr)
+            self._db = self._connect(':memory:')
+            self.persistent = False
+        else:
+            self.persistent = True
+
+        atexit.register(self.flush)
+
+    def _connect(self, fname: str) -> sqlite3.Connection:
+        db = sqlite3.connect(fname, timeout=self.timeout)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS equality ('
+                       'c1 TEXT NOT NULL, c2 TEXT NOT NULL, '
+                       'result TEXT NOT NULL, '
+                       'PRIMARY KEY (c1, c2)) WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS fingerprint ('
+                       'oid TEXT PRIMARY KEY, patch TEXT NOT NULL, '
+                       'message TEXT NOT NULL) WITHOUT ROWID')
+            db.execute('CREATE TABLE IF NOT EXISTS range_log ('
+                       'base TEXT NOT NULL, top TEXT NOT NULL, '
+                       'created REAL NOT NULL, records BLOB NOT NULL, '
+                       'PRIMARY KEY (base, top)) WITHOUT ROWID')
+        return db
+
+    def full_id(self, h: str) -> Optional[str]:
+        """Resolve commit @h to full commit id"""
+        if h not in self._full_ids:
+            self._full_ids[h] = git_rev_parse(h + '^{commit}')
+
+        return self._full_ids[h]
+
+    def _full_pair(self, h1: str, h2: str) -> Optional[Tuple[str, str]]:
+        f1, f2 = self.full_id(h1), self.full_id(h2)
+        if f1 is None or f2 is None:
+            return None
+
+        return sorted_pair(f1, f2)
 
     def get(self, h1: str, h2: str) -> Optional[IsEqual]:
-        return self._dict.get(sorted_pair(h1, h2))
+        pair = self._full_pair(h1, h2)
+        if pair is None:
+            return None
+
+        if pair in self._pending:
+            return self._pending[pair]
+
+        row = self._db.execute('SELECT result FROM equality '
+                               'WHERE c1 = ? AND c2 = ?', pair).fetchone()
+        return None if row is None else IsEqual[row[0]]
 
     def add(self, h1: str, h2: str, equal: IsEqual) -> None:
-        pair = sorted_pair(h1, h2)
-        self._dict[pair] = equal
+        pair = self._full_pair(h1, h2)
+        if pair is None:
+            return
+
+        self._pending[pair] = equal
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def get_fingerprints(self, commits: Iterable[str]) -> \
+            Dict[str, Fingerprint]:
+        """Returns dict {commit: fingerprint} for found commits"""
+        full = {}
+        for c in commits:
+            f = self.full_id(c)
+            if f is not None:
+                full.setdefault(f, []).append(c)
+
+        res = {}
+        for f in full.keys() & self._pending_fps.keys():
+            for c in full.pop(f):
+                res[c] = self._pending_fps[f]
+
+        oids = list(full)
+        for i in range(0, len(oids), 500):
+            chunk = oids[i:i + 500]
+            for oid, patch, message in self._db.execute(
+                    'SELECT * FROM fingerprint WHERE oid IN ({})'.format(
+                        ', '.join('?' * len(chunk))), chunk):
+                for c in full[oid]:
+                    res[c] = Fingerprint(patch=patch, message=message)
+
+        return res
+
+    def add_fingerprint(self, full_id: str, fp: Fingerprint) -> None:
+        self._pending_fps[full_id] = fp
+        if len(self._pending_fps) >= self.batch_size:
+            self.flush()
+
+    def get_range_log(self, base: str, top: str) -> \
+            Optional[List[List[str]]]:
+        """Get log records of range @base..@top, given by full commit ids"""
+        row = self._db.execute('SELECT records FROM range_log '
+                               'WHERE base = ? AND top = ?',
+                               (base, top)).fetchone()
+        return None if row is None else \
+            json.loads(zlib.decompress(row[0]).decode())
+
+    def range_log_tops(self, base: str, limit: int) -> List[str]:
+        """Tops of last @limit cached ranges starting from @base"""
+        return [row[0] for row in self._db.execute(
+            'SELECT top FROM range_log WHERE base = ? '
+            'ORDER BY created DESC LIMIT ?', (base, limit))]
+
+    def add_range_log(self, base: str, top: str, records: List[List[str]],
+                      replaces: Optional[str] = None) -> None:
+        """Save log records of range @base..@top
+
+        Range @base..@replaces is dropped, as it is superseded by the new
+        one.
+        """
+        data = zlib.compress(json.dumps(records).encode())
+        try:
+            with self._db:
+                if replaces is not None:
+                    self._db.execute('DELETE FROM range_log '
+                                     'WHERE base = ? AND top = ?',
+                                     (base, replaces))
+                self._db.execute(
+                    'INSERT OR REPLACE INTO range_log VALUES (?, ?, ?, ?)',
+                    (base, top, time.time(), data))
+        except sqlite3.OperationalError as e:
+            print(f'Failed to update cache {self.fname}: {e}',
+                  file=sys.stderr)
+
+    def flush(self) -> None:
+        if not self._pending and not self._pending_fps:
+            return
+
+        try:
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO equality VALUES (?, ?, ?)',
+                    ((c1, c2, e.name)
+                     for (c1, c2), e in self._pending.items()))
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO fingerprint VALUES (?, ?, ?)',
+                    ((oid, fp.patch, fp.message)
+                     for oid, fp in self._pending_fps.items()))
+        except sqlite3.OperationalError as e:
+            # Most probably the database is locked for too long. Results
+            # are kept in memory, we'll retry on next flush.
+            print(f'Failed to update cache {self.fname}: {e}',
+                  file=sys.stderr)
+            return
+
+        self._pending.clear()
+        self._pending_fps.clear()
+
+    def import_text_cache(self, fname: str) -> None:
+        """Move comparison results from old text cache @fname, keyed by
+        abbreviated hashes, to the database
+
+        Abbreviated hashes are resolved by one git process. Pairs which
+        can't be resolved (commits are gone or abbreviation became
+        ambiguous) are dropped. The file is removed after successful
+        import.
+        """
+        if not self.persistent:
+            return
+
+        # Take the file, so that concurrent process doesn't import it too
+        taken = f'{fname}.import-{os.getpid()}'
+        try:
+            os.rename(fname, taken)
+        except FileNotFoundError:
+            return
+
+        results = {}
+        dropped = 0
+        with open(taken, errors='replace') as f:
+            for line in f:
+                try:
+                    h1, h2, result = line.split()
+                    results[h1, h2] = IsEqual[result]
+                except (KeyError, ValueError):
+                    dropped += 1
+
+        abbrevs = list({h for pair in results for h in pair})
+        full = {}
+        if abbrevs:
+            out = git('cat-file --batch-check',
+                      input=''.join(h + '^{commit}\n' for h in abbrevs),
+                      stderr=subprocess.DEVNULL).splitlines()
+            for h, line in zip(abbrevs, out):
+                fields = line.split()
+                if len(fields) == 3:
+                    full[h] = fields[0]
+
+        rows = {}
+        for (h1, h2), e in results.items():
+            if h1 in full and h2 in full:
+                rows[sorted_pair(full[h1], full[h2])] = e
+            else:
+                dropped += 1
+
+        try:
+            with self._db:
+                # Results already in the database are newer
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO equality VALUES (?, ?, ?)',
+                    ((c1, c2, e.name) for (c1, c2), e in rows.items()))
+        except sqlite3.OperationalError as e:
+            print(f'Failed to import old cache {fname}: {e}',
+                  file=sys.stderr)
+            os.rename(taken, fname)
+            return
+
+        os.unlink(taken)
+        print(f'Imported {len(rows)} comparison results from old cache '
+              f'{fname}, dropped {dropped} not resolvable ones',
+              file=sys.stderr)
+
+    def gc(self) -> int:
+        """Drop results, fingerprints and range logs for commits,
+        unreachable from any ref or reflog
+
+        Returns number of dropped comparison results.
+        """
+        self.flush()
+
+        reachable = git('rev-list --all --reflog').split()
+        with self._db:
+            self._db.execute('CREATE TEMP TABLE reachable '
+                             '(oid TEXT PRIMARY KEY) WITHOUT ROWID')
+            self._db.executemany('INSERT OR IGNORE INTO reachable VALUES (?)',
+                                 ((oid,) for oid in reachable))
+            dropped = self._db.execute(
+                'DELETE FROM equality '
+                'WHERE c1 NOT IN (SELECT oid FROM reachable) '
+                'OR c2 NOT IN (SELECT oid FROM reachable)').rowcount
+            self._db.execute('DELETE FROM fingerprint '
+                             'WHERE oid NOT IN (SELECT oid FROM reachable)')
+            self._db.execute('DELETE FROM range_log '
+                             'WHERE base NOT IN (SELECT oid FROM reachable) '
+                             'OR top NOT IN (SELECT oid FROM reachable)')
+            self._db.execute('DROP TABLE reachable')
+        self._db.execute('VACUUM')
+
+        return dropped
+
+
+@functools.lru_cache(maxsize=None)
+def get_cache() -> EqualityCache:
+    """Open the cache on first use, so that runs which don't compare
+    anything don't pay for it.
+    """
+    cache = EqualityCache(os.path.join(git_get_cache_dir(),
+                                       'commit-equality-cache.db'))
+
+    old_fname = os.path.join(git_get_git_dir(), 'commit-equality-cache')
+    if os.path.exists(old_fname):
+        cache.import_text_cache(old_fname)
+
+    return cache
+
+
+FINGERPRINTS: Dict[str, Fingerprint] = {}
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def patch_hash(chunks: Iterable[bytes]) -> str:
+    """text_hash(eat_numbers(patch)) of patch, given by chunks of UTF-8"""
+    h = PatchHasher()
+    for chunk in chunks:
+        h.update(chunk)
+    return h.hexdigest()
+
+
+LOG_PATCHES_CMD = 'log --no-walk=unsorted --stdin -p --cc ' \
+    "--format='%x00%H%x00%h%x00%B%x00'"
+
+
+def iter_commit_patches(commits: Iterable[str]) -> \
+        Iterator[Tuple[str, str, str, str]]:
+    """Get patches of @commits by one git process
+
+    Yields tuples (full hash, abbreviated hash, message, patch) in order of
+    @commits, as git produces them. Patch is the same as printed by
+    "git show --format=".
+    """
+    fields = git_stream(LOG_PATCHES_CMD, input='\n'.join(commits) + '\n',
+                        stderr=subprocess.DEVNULL)
+
+    # Output starts with separator, skip the empty field before it
+    next(fields)
+    for full, abbrev, message, patch in zip(fields, fields, fields, fields):
+        yield full, abbrev, message, patch.lstrip('\n')
 
-        with open(self.fname, 'a') as f:
-            f.write('{} {} {}\n'.format(pair[0], pair[1], equal.name))
 
+EMAIL_START_REGEX = re.compile(r'From ([0-9a-f]{40,64}) ')
 
-CACHE = EqualityCache(os.path.join(git_get_git_dir(), 'commit-equality-cache'))
+
+def iter_email_patches(commits: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """Get patches of @commits in email format by one git process
+
+    Yields tuples (full hash, patch) in order of @commits. Patch is the same
+    as printed by "git show --format=email".
+    """
+    def show(full: str) -> str:
+        return git(f'show --format=email {full}')
+
+    current = None
+    # Pieces are separated by NUL. For a merge without combined diff git
+    # log prints an additional separator, where git show prints an empty
+    # line. Such rare commits are just shown separately.
+    for piece in git_stream('log -z --no-walk=unsorted --stdin -p --cc '
+                            '--format=email',
+                            input='\n'.join(commits) + '\n'):
+        m = EMAIL_START_REGEX.match(piece)
+        if m is not None:
+            if current is not None:
+                yield current
+            current = m.group(1), piece
+        elif current is not None and not piece:
+            yield current[0], show(current[0])
+            current = None
+
+    if current is not None:
+        yield current
+
+
+def iter_fingerprints(commits: Iterable[str]) -> \
+        Iterator[Tuple[str, Fingerprint]]:
+    """Get fingerprints of @commits by one git process
+
+    Yields tuples (full hash, fingerprint) in order of @commits. Same as
+    hashing results of iter_commit_patches(), but patches are hashed by
+    chunks as git produces them, so they are never kept in memory.
+    """
+    pieces = git_stream_pieces(LOG_PATCHES_CMD,
+                               input='\n'.join(commits) + '\n',
+                               stderr=subprocess.DEVNULL)
+
+    # Fields before the patch, output starts with separator, so the first
+    # one is empty. For next commits empty field is added to keep indexes.
+    fields: List[str] = []
+    field: List[str] = []
+    hasher = None
+    patch_started = False
+    for piece, last in pieces:
+        if hasher is None:
+            field.append(piece)
+            if last:
+                fields.append(''.join(field))
+                field = []
+                if len(fields) == 4:
+                    hasher = PatchHasher()
+                    patch_started = False
+            continue
+
+        if not patch_started:
+            # Same as lstrip('\n') in iter_commit_patches()
+            piece = piece.lstrip('\n')
+            patch_started = bool(piece)
+        # Pieces are decoded text, so line endings are translated the same
+        # way as for iter_commit_patches(): fingerprints are kept in cache
+        hasher.update(piece.encode('utf-8'))
+
+        if last:
+            _, full, _, message = fields
+            yield full, Fingerprint(patch=hasher.hexdigest(),
+                                    message=text_hash(message.strip()))
+            fields = ['']
+            hasher = None
+
+
+def _load_fingerprints_chunk(commits: List[str]) -> Dict[str, Fingerprint]:
+    """Returns dict {full hash: fingerprint}"""
+    try:
+        return dict(iter_fingerprints(commits))
+    except subprocess.CalledProcessError:
+        return {}
+
+
+def load_fingerprints(commits: Iterable[str], jobs: int = 1) -> None:
+    """Calculate fingerprints for all @commits
+
+    Commits are split into @jobs chunks, each chunk is loaded by one git
+    process, chunks are loaded in parallel threads.
+
+    Commits with already known fingerprints are skipped, fingerprints
+    stored in the cache are not recalculated. Non-existing commits are
+    skipped too, commit_fingerprint() will fail for them.
+    """
+    cache = get_cache()
+    todo = {c for c in commits if c not in FINGERPRINTS}
+    if not todo:
+        return
+
+    cached = cache.get_fingerprints(todo)
+    FINGERPRINTS.update(cached)
+    STATS.cache_lookups('fingerprint', len(cached), len(todo) - len(cached))
+
+    by_full: Dict[str, List[str]] = {}
+    for c in todo - cached.keys():
+        full = cache.full_id(c)
+        if full is not None:
+            by_full.setdefault(full, []).append(c)
+
+    full_ids = sorted(by_full)
+    jobs = min(jobs, len(full_ids))
+    if jobs > 1:
+        with ThreadPoolExecutor(jobs) as executor:
+            chunks = executor.map(_load_fingerprints_chunk,
+                                  (full_ids[i::jobs] for i in range(jobs)))
+            loaded = {}
+            for chunk in chunks:
+                loaded.update(chunk)
+    elif full_ids:
+        loaded = _load_fingerprints_chunk(full_ids)
+    else:
+        return
+
+    for full, fp in loaded.items():
+        cache.add_fingerprint(full, fp)
+        FINGERPRINTS[full] = fp
+        for c in by_full[full]:
+            FINGERPRINTS[c] = fp
+
+
+def load_pairs_fingerprints(pairs: Iterable[Tuple[str, str]],
+                            jobs: int = 1) -> None:
+    """Load fingerprints, needed to compare not yet cached pairs"""
+    load_fingerprints((c for c1, c2 in set(pairs)
+                       if c1 != c2 and get_cache().get(c1, c2) is None
+                       for c in (c1, c2)), jobs)
+
+
+def commit_fingerprint(commit: str) -> Fingerprint:
+    """Get fingerprint of the commit, calculating it only once per commit"""
+    if commit not in FINGERPRINTS:
+        load_fingerprints([commit])
+        if commit not in FINGERPRINTS:
+            sys.exit(f'Failed to load commit {commit}')
+
+    return FINGERPRINTS[commit]
+
+
+def equality_key(commit: str, ignore_cmsg: bool) -> Tuple[str, ...]:
+    """Commits are equal in terms of are_commits_equal() if and only if their
+    keys are equal.
+    """
+    fp = commit_fingerprint(commit)
+    return (fp.patch,) if ignore_cmsg else (fp.patch, fp.message)
+
+
+class CheckedIndex:
+    """Index of commit pairs, checked by hand
+
+    Pairs are indexed by equality keys of commits, so check that some pair
+    is equal to one of checked pairs is a single lookup. Fingerprints of
+    the commits should be loaded in advance, pairs with commits that can't
+    be loaded are ignored.
+    """
+    def __init__(self, pairs: Iterable[Tuple[str, str]],
+                 ignore_cmsg: bool) -> None:
+        self.ignore_cmsg = ignore_cmsg
+        self._keys = set()
+
+        for a, b in pairs:
+            if a not in FINGERPRINTS or b not in FINGERPRINTS:
+                continue
+            ka = equality_key(a, ignore_cmsg)
+            kb = equality_key(b, ignore_cmsg)
+            self._keys.add((ka, kb))
+            self._keys.add((kb, ka))
+
+    def __contains__(self, pair: Tuple[str, str]) -> bool:
+        return (equality_key(pair[0], self.ignore_cmsg),
+                equality_key(pair[1], self.ignore_cmsg)) in self._keys
 
 
 def are_commits_equal(c1: str, c2: str, ignore_cmsg: bool) -> bool:
@@ -84,19 +692,20 @@ def are_commits_equal(c1: str, c2: str, ignore_cmsg: bool) -> bool:
     if c1 == c2:
         return True
 
-    e = CACHE.get(c1, c2)
+    e = get_cache().get(c1, c2)
+    STATS.cache_lookup('equality', e is not None)
     if e is None:
-        c1_text = eat_numbers(git('show --format= ' + c1))
-        c2_text = eat_numbers(git('show --format= ' + c2))
+        fp1 = commit_fingerprint(c1)
+        fp2 = commit_fingerprint(c2)
 
-        if c1_text != c2_text:
+        if fp1.patch != fp2.patch:
             e = IsEqual.DIFFERS
-        elif git_log1('%B', c1) == git_log1('%B', c2):
+        elif fp1.message == fp2.message:
             e = IsEqual.FULL_EQUAL
         else:
             e = IsEqual.EQUAL
 
-        CACHE.add(c1, c2, e)
+        get_cache().add(c1, c2, e)
 
     return e == IsEqual.FULL_EQUAL or \
         (ignore_cmsg and e == IsEqual.EQUAL)
@@ -110,7 +719,7 @@ class IntrCompRes:
     @ok: user marked the commit pair as OK
     @stop: user requested stop of interactive processing
     @comment: an updated comment
-    @new_c1, @new_c2: set if successfully rebased
+    @new_c1, @new_c2: full id of the commit, if it is successfully rewritten
     """
     equal: bool = False
     ok: bool = False
@@ -168,7 +777,8 @@ def run_vim(f1: str, f2: str, comment_path: Optional[str],
 
     cmd += ['-c', ':norm gg']
 
-    code = subprocess.run(cmd, check=False).returncode
+    with STATS.git_call('vim'):
+        code = subprocess.run(cmd, check=False).returncode
     return IntrCompRes(ok=(code == 200), stop=(code not in (0, 200)))
 
 
@@ -273,8 +883,7 @@ def apply_patch_changes(commit_hash: str, branch: str, orig_patch: str,
     if not branch or branch != check_git_clean_branch():
         return tri_way('git is unclean or not at branch', retry=False)
 
-    commit_hash = git_log1('%h', commit_hash)
-    if commit_hash not in git_log('%h', branch):
+    if not git_is_ancestor(commit_hash, branch):
         return tri_way('you are trying to modify commit that is not in the '
                        'current branch')
 
@@ -285,40 +894,122 @@ def apply_patch_changes(commit_hash: str, branch: str, orig_patch: str,
         return tri_way('unparseable changes in patch')
 
     try:
-        # checkout prints a lot of information to stderr even on success
-        git(f'checkout {commit_hash}^', stderr=subprocess.DEVNULL)
-    except subprocess.CalledProcessError:
-        return tri_way('git checkout failed', retry=False)
+        new_hash = rewrite_commit(commit_hash, branch, updated_patch)
+    except RewriteError as e:
+        return tri_way(str(e), retry=e.retry)
 
-    try:
-        git('am', input=updated_patch)
-    except subprocess.CalledProcessError:
-        w = tri_way('git am failed',
-                    stop_help='You will be left in git-am session. '
-                    f'Use "git am --abort", then "git checkout {branch}" '
-                    'to rollback.')
-        if w != TriWay.STOP:
-            git('am --abort')
-            git('checkout -')
-        return w
-
-    applied_hash = git_log1('%h', 'HEAD')
-    git(f'checkout {branch}', stderr=subprocess.DEVNULL)
-    try:
-        git(f'rebase {applied_hash}')
-    except subprocess.CalledProcessError:
-        w = tri_way('git rebase failed',
-                    stop_help='You will probably be in a git rebase '
-                    'conflict. Use "git rebase --abort" to rollback.')
-        if w != TriWay.STOP:
-            git('rebase --abort')
-        return w
+    return ApplyResult(TriWay.SKIP, new_hash)
 
-    return ApplyResult(TriWay.SKIP, applied_hash)
+
+@dataclass
+class PreparedPair:
+    """Patches of two commits, prepared for interactive comparison
+    @c1_orig, @c2_orig: patches in email format
+    @c1_filtered, @c2_filtered: same patches, filtered by eat_numbers()
+    @f1, @f2: temporary files with filtered patches to open in vim, not
+              created for equal commits
+    """
+    c1_orig: str
+    c1_filtered: str
+    c2_orig: str
+    c2_filtered: str
+    f1: str = ''
+    f2: str = ''
+    tmp_dir: str = ''
+
+    @property
+    def equal(self) -> bool:
+        return self.c1_filtered == self.c2_filtered
+
+    def cleanup(self) -> None:
+        if self.tmp_dir:
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+def prepare_pair(c1: str, c2: str, c2_ind: Optional[int] = None) -> \
+        PreparedPair:
+    full = [git_rev_parse(c + '^{commit}') for c in (c1, c2)]
+    if None in full:
+        sys.exit(f'Failed to load commits {c1} {c2}')
+
+    patches = dict(iter_email_patches(full))
+    names = {h: (abbrev, subj) for h, abbrev, subj in git_log_records(
+        ['%H', '%h', '%f'], '--no-walk=unsorted --stdin',
+        input=''.join(f'{h}\n' for h in full))}
+
+    pair = PreparedPair(
+        c1_orig=patches[full[0]],
+        c1_filtered=eat_numbers(patches[full[0]], ignore_empty_lines=False),
+        c2_orig=patches[full[1]],
+        c2_filtered=eat_numbers(patches[full[1]], ignore_empty_lines=False))
+    if pair.equal:
+        return pair
+
+    pair.tmp_dir = mkdtemp(prefix='git-check-rebase-')
+    f2_prefix = '' if c2_ind is None else f'[{c2_ind}]'
+    pair.f1 = os.path.join(pair.tmp_dir, '%s-%s.patch' % names[full[0]])
+    pair.f2 = os.path.join(pair.tmp_dir,
+                           f2_prefix + '%s-%s.patch' % names[full[1]])
+    for fname, text in ((pair.f1, pair.c1_filtered),
+                        (pair.f2, pair.c2_filtered)):
+        with open(fname, 'w') as f:
+            f.write(text)
+
+    return pair
+
+
+PairKey = Tuple[str, str, Optional[int]]
+
+
+class PairPrefetcher:
+    """Prepare pairs for interactive_compare_commits() in background
+
+    Pairs are given as (c1, c2, c2_ind) tuples, up to @depth of them are
+    prepared in parallel threads, while user compares the current pair.
+    Should be used as context manager, temporary files of not used pairs
+    are removed on exit.
+    """
+    def __init__(self, depth: int = 2) -> None:
+        self.depth = depth
+        self._pool = ThreadPoolExecutor(max(depth, 1))
+        self._futures: Dict[PairKey, Future] = {}
+
+    def __enter__(self) -> 'PairPrefetcher':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.invalidate()
+        self._pool.shutdown()
+
+    def prefetch(self, pairs: List[PairKey]) -> None:
+        """Start preparing of first @depth of @pairs"""
+        for key in pairs[:self.depth]:
+            if key not in self._futures:
+                self._futures[key] = self._pool.submit(prepare_pair, *key)
+
+    def get(self, c1: str, c2: str, c2_ind: Optional[int]) -> PreparedPair:
+        fut = self._futures.pop((c1, c2, c2_ind), None)
+        if fut is None:
+            return prepare_pair(c1, c2, c2_ind)
+
+        return fut.result()
+
+    def invalidate(self) -> None:
+        """Drop all prefetched pairs, must be called when history is
+        rewritten
+        """
+        for fut in self._futures.values():
+            if fut.cancel():
+                continue
+            try:
+                fut.result().cleanup()
+            except (subprocess.CalledProcessError, SystemExit):
+                pass
+        self._futures.clear()
 
 
 def interactive_compare_commits(c1, c2, c1_branch, c2_branch,
-                                c2_ind=None, comment=None):
+                                c2_ind=None, comment=None, prefetcher=None):
     """
     @comment: if None, do simple comparison of two commits and nothing more.
               if str (may be empty), create also temporary file for the
@@ -327,24 +1018,27 @@ def interactive_compare_commits(c1, c2, c1_branch, c2_branch,
                 which must be current branch.
     @c2_branch: similar for c2. @c1_branch and @c2_branch must not be non-empty
                 in the same time
+    @prefetcher: if not None, PairPrefetcher, which may already have the
+                 pair prepared
     """
     assert not (c1_branch and c2_branch)
-    c1_orig = git('show --format=email ' + c1)
-    c1_filtered = eat_numbers(c1_orig, ignore_empty_lines=False)
-    c2_orig = git('show --format=email ' + c2)
-    c2_filtered = eat_numbers(c2_orig, ignore_empty_lines=False)
-    if c1_filtered == c2_filtered:
+    if prefetcher is None:
+        pair = prepare_pair(c1, c2, c2_ind)
+    else:
+        pair = prefetcher.get(c1, c2, c2_ind)
+    if pair.equal:
         return IntrCompRes(equal=True)
 
-    f1 = git_log1('/tmp/%h-%f.patch', c1)
-    with open(f1, 'w') as f:
-        f.write(c1_filtered)
+    try:
+        return _interactive_compare_pair(c1, c2, c1_branch, c2_branch, pair,
+                                         comment)
+    finally:
+        pair.cleanup()
 
-    f2_prefix = '' if c2_ind is None else f'[{c2_ind}]'
-    f2 = git_log1(f'/tmp/{f2_prefix}%h-%f.patch', c2)
-    with open(f2, 'w') as f:
-        f.write(c2_filtered)
 
+def _interactive_compare_pair(c1, c2, c1_branch, c2_branch,
+                              pair: PreparedPair, comment) -> IntrCompRes:
+    f1, f2 = pair.f1, pair.f2
     if comment is None:
         comment_path = None
         meta_tab_opened = False
@@ -357,7 +1051,8 @@ def interactive_compare_commits(c1, c2, c1_branch, c2_branch,
     while True:
         res = run_vim(f1, f2, comment_path, meta_tab_opened)
 
-        ar = apply_patch_changes(c1, c1_branch, c1_orig, c1_filtered, f1)
+        ar = apply_patch_changes(c1, c1_branch, pair.c1_orig,
+                                 pair.c1_filtered, f1)
         if ar.action == TriWay.RETRY:
             continue
 
@@ -367,7 +1062,8 @@ def interactive_compare_commits(c1, c2, c1_branch, c2_branch,
 
         res.new_c1 = ar.new_hash
 
-        ar = apply_patch_changes(c2, c2_branch, c2_orig, c2_filtered, f2)
+        ar = apply_patch_changes(c2, c2_branch, pair.c2_orig,
+                                 pair.c2_filtered, f2)
         if ar.action == TriWay.RETRY:
             continue
 
@@ -1,16 +1,23 @@
 import re
+import subprocess
 
+from itertools import chain
 from enum import Enum
 from dataclasses import dataclass
 from typing import List, Optional, Any, Tuple, Dict
 
-from .simple_git import git_log_table, git
-from .compare_commits import are_commits_equal
+from .simple_git import git, git_log_records, git_rev_parse, \
+    git_is_ancestor, git_commit_tags, git_abbrev_commits
+from .compare_commits import are_commits_equal, load_fingerprints, \
+    load_pairs_fingerprints, CheckedIndex, iter_commit_patches, get_cache
+from .similarity import changed_lines, match_similar
+from .stats import STATS
 from .check_rebase_meta import subject_to_key, text_add_indent, Meta, \
     CommitMeta
 
 from .viewable import Span, GitHashCell, CompRes, VTable, VTableRow
 from .parse_issues import parse_issues
+from .issue_cache import CachingTracker, get_issue_cache
 
 
 class NoBaseError(Exception):
@@ -68,33 +75,189 @@ def parse_range(definition: str, default_base: Optional[str] = None) -> \
 @dataclass
 class Commit:
     commit_hash: str
+    full_hash: str
     author_date: str
     author_name: str
     subject: str
     in_tag: str
+    message: str
 
 
-def git_log_commits(git_range):
+# Only full ids are cached: abbreviation, unique when cached, may become
+# ambiguous as the repository grows
+LOG_FIELDS = ['%H', '%ad', '%an', '%s', '%B']
+
+# How many cached ranges with same base to check as a start for the new one
+LOG_CACHE_CANDIDATES = 3
+
+
+def _get_range_log(base: str, top: str) -> Optional[List[List[str]]]:
+    """Get cached log of @base..@top, None if not cached"""
+    records = get_cache().get_range_log(base, top)
+    if records and len(records[0]) != len(LOG_FIELDS):
+        # Cached by older version with other fields
+        return None
+    return records
+
+
+def _extend_range_log(base: str, old_top: str, top: str,
+                      old_records: List[List[str]]) -> List[List[str]]:
+    """Get log of @base..@top, when log of @base..@old_top is known and
+    @old_top is an ancestor of @top
+    """
+    new = list(git_log_records(LOG_FIELDS + ['%P'],
+                               f'^{base} ^{old_top} {top}'))
+
+    parent = old_top
+    for rec in new:
+        if rec[-1] != parent:
+            break
+        parent = rec[0]
+    else:
+        # Linear history on top of old_top: full log would show the same
+        return old_records + [rec[:-1] for rec in new]
+
+    # New commits may be mixed with old ones, get the order from git
+    by_id = {rec[0]: rec for rec in old_records}
+    by_id.update((rec[0], rec[:-1]) for rec in new)
+    return [by_id[oid] for oid in
+            git(f'rev-list --reverse {base}..{top}').split()]
+
+
+def _git_log_range(base: str, top: str) -> List[List[str]]:
+    """Get LOG_FIELDS records of not cached range @base..@top, given by
+    full commit ids
+    """
+    cache = get_cache()
+    for old_top in cache.range_log_tops(base, LOG_CACHE_CANDIDATES):
+        if git_is_ancestor(old_top, top):
+            old_records = _get_range_log(base, old_top)
+            if old_records is None:
+                # dropped by concurrent process
+                continue
+            records = _extend_range_log(base, old_top, top, old_records)
+            cache.add_range_log(base, top, records, replaces=old_top)
+            return records
+
+    records = list(git_log_records(LOG_FIELDS, f'{base}..{top}'))
+    cache.add_range_log(base, top, records)
+    return records
+
+
+def _git_log_linear_ranges(ranges: List[Tuple[str, str]]) -> \
+        Dict[Tuple[str, str], List[List[str]]]:
+    """Log several ranges, given by full commit ids, by one git call
+
+    Commits reachable from any of tops but none of bases are logged
+    together with their parents. Ranges which are linear chains from top
+    down to base are cut from this log. Other ranges (merges inside,
+    commits of the range excluded by other range base) are not returned.
+
+    Base, which is a top of another range (like in a..b,b..c), is not
+    excluded, as it would exclude the whole other range.
+    """
+    tops = {top for _, top in ranges}
+    stdin = ''.join(f'{top}\n' for top in tops) + \
+        ''.join(f'^{base}\n' for base, _ in ranges if base not in tops)
+    by_id = {rec[0]: rec for rec in
+             git_log_records(LOG_FIELDS + ['%P'], '--stdin', input=stdin)}
+
+    res = {}
+    for base, top in ranges:
+        chain = []
+        oid = top
+        while oid != base:
+            rec = by_id.get(oid)
+            if rec is None or len(rec[-1].split()) != 1:
+                break
+            chain.append(rec[:-1])
+            oid = rec[-1]
+        else:
+            res[base, top] = chain[::-1]
+
+    return res
+
+
+def git_log_ranges(ranges: List[Tuple[str, str]]) -> List[List[List[str]]]:
+    """Get LOG_FIELDS records for each of @ranges (pairs of base and top)
+
+    Logs are cached. If top of the range moved forward since last run,
+    only new commits are logged. All not cached linear ranges are logged
+    by one git call.
+    """
+    ids = []
+    logs = {}
+    for base, top in ranges:
+        base_id = git_rev_parse(base + '^{commit}')
+        top_id = git_rev_parse(top + '^{commit}')
+        if base_id is None or top_id is None:
+            # Let git report the error, if any
+            logs[base, top] = list(git_log_records(LOG_FIELDS,
+                                                   f'{base}..{top}'))
+            ids.append((base, top))
+        else:
+            ids.append((base_id, top_id))
+
+    cache = get_cache()
+    for rng in set(ids) - logs.keys():
+        records = _get_range_log(*rng)
+        STATS.cache_lookup('range_log', records is not None)
+        if records is not None:
+            logs[rng] = records
+
+    missing = [rng for rng in dict.fromkeys(ids) if rng not in logs]
+    if len(missing) > 1:
+        found = _git_log_linear_ranges(missing)
+        for rng, records in found.items():
+            cache.add_range_log(*rng, records)
+        logs.update(found)
+
+    for rng in missing:
+        if rng not in logs:
+            logs[rng] = _git_log_range(*rng)
+
+    return [logs[rng] for rng in ids]
+
+
+def git_log_commits(ranges: List[Tuple[str, str]]) -> List[Commit]:
+    """Get commits of @ranges (pairs of base and top)
+
+    Commit, included into several ranges, is returned only once, as part
+    of the first one.
+    """
+    tags = git_commit_tags()
+    logs = git_log_ranges(ranges)
+    abbrevs = git_abbrev_commits(
+        dict.fromkeys(rec[0] for records in logs for rec in records))
     res = []
-    for h, ad, an, d, s in git_log_table('%h %ad %an %D %s', git_range):
-        tag = ''
-        if 'tag:' in d:
-            desc = next(x for x in d.split(',')
-                        if x.strip().startswith('tag:'))
-            tag = desc.split(':', 1)[1].strip()
-            if not re.fullmatch(r'v([0-9]+\.)*[0-9]+', tag):
-                tag = None
-        res.append(Commit(commit_hash=h, author_date=ad,
-                          author_name=an, subject=s, in_tag=tag))
-
-    current_tag = ''
-    for c in reversed(res):
-        if c.in_tag:
-            current_tag = c.in_tag
-            continue
-
-        if current_tag:
-            c.in_tag = current_tag
+    seen = set()
+    for records in logs:
+        commits = []
+        for full_hash, ad, an, s, b in records:
+            tag = ''
+            if full_hash in tags:
+                # git log %D shows tags in reverse order, we take the first
+                tag = max(tags[full_hash])
+                if not re.fullmatch(r'v([0-9]+\.)*[0-9]+', tag):
+                    tag = None
+            commits.append(Commit(commit_hash=abbrevs[full_hash],
+                                  full_hash=full_hash, author_date=ad,
+                                  author_name=an, subject=s, in_tag=tag,
+                                  message=b))
+
+        current_tag = ''
+        for c in reversed(commits):
+            if c.in_tag:
+                current_tag = c.in_tag
+                continue
+
+            if current_tag:
+                c.in_tag = current_tag
+
+        for full_hash, c in zip((rec[0] for rec in records), commits):
+            if full_hash not in seen:
+                seen.add(full_hash)
+                res.append(c)
 
     return res
 
@@ -115,16 +278,16 @@ class MultiRange:
         else:
             self.base, self.top = parse_range(definition, default_base)
 
-        self.commits = []
-        for rng in definition.split(','):
-            base, top = parse_range(rng, default_base)
-            self.commits.extend(git_log_commits(f'{base}..{top}'))
+        self.commits = git_log_commits(
+            [parse_range(rng, default_base) for rng in definition.split(',')])
 
         self.by_key = {}
         for i, c in enumerate(self.commits):
             key = subject_to_key(c.subject, meta)
             self.by_key[key] = i, c
 
+        self.by_full_hash = {c.full_hash: c for c in self.commits}
+
 
 class Column(Enum):
     INDEX = 1
@@ -168,18 +331,18 @@ class Row:
         self._meta = meta
         self._key = subject_to_key(c.subject, meta)
 
-        msg = git(f'log -1 {c.commit_hash}')
+        msg = c.message
         self.cherry = 'cherry picked' in msg
         self.msg_issues = list(set(re.findall(r'\b[A-Z]+-\d+\b(?!-)', msg)))
         self.msg_issues.sort(key=lambda x: int(x.split('-', 1)[1]))
 
-        m = re.search(r'^    Feature: (.*)$', msg, re.MULTILINE)
+        m = re.search(r'^Feature: (.*)$', msg, re.MULTILINE)
         if m:
             self.feature = m.group(1)
         else:
             self.feature = self.meta.feature if self.meta else None
 
-        m = re.search(r'^    Upstreaming: (.*)$', msg, re.MULTILINE)
+        m = re.search(r'^Upstreaming: (.*)$', msg, re.MULTILINE)
         if m:
             self.upstreaming = m.group(1)
         else:
@@ -277,66 +440,197 @@ class Table:
         self.meta = meta
         self.ranges = ranges
         self.rows = []
+        self.issues_map: Dict[str, List[Any]] = {}
+        # Matches found by match_by_content(), to be kept when rows are
+        # rebuilt: {(range index, row key) => full hash of commit}
+        self.proposed: Dict[Tuple[int, str], str] = {}
 
-        corresponding = [len(r.commits) == len(ranges[-1].commits)
-                         for r in ranges[:-1]]
+        self.corresponding = self._find_corresponding()
 
         for i, c in enumerate(ranges[-1].commits):
             an = c.author_name
             if an == 'Vladimir Sementsov-Ogievskiy':  # too long :)
                 an = "Vladimir S-O"
 
-            key = subject_to_key(c.subject, meta)
-            row = Row(ranges, i, meta)
-
-            for r_ind, r in enumerate(ranges[:-1]):
-                if key in r.by_key:
-                    j, c2 = r.by_key[key]
-                    in_tag = ''
-                    if r_ind in (row.up_ind, row.new_ind):
-                        in_tag = c2.in_tag
-                    row.commits[r_ind] = GitHashCell(c2.commit_hash,
-                                                     in_tag=in_tag)
-                    if j != i:
-                        corresponding[r_ind] = False
-
-            self.rows.append(row)
-
-        # If user cares to pass ranges of same length, and all found commits
-        # have same index in range as corresponding commit in last range,
-        # assume that non-found commits are just renamed but stay at same
-        # position.
-        for i in range(len(ranges) - 1):
-            if not corresponding[i]:
-                continue
+            self.rows.append(self._make_row(i))
+
+    def _find_corresponding(self) -> List[bool]:
+        """For each range but the last, check if it corresponds to the last
+        one: if user cares to pass ranges of same length, and all found
+        commits have same index in range as corresponding commit in last
+        range, assume that non-found commits are just renamed but stay at
+        same position.
+        """
+        last = self.ranges[-1].commits
+        keys = [subject_to_key(c.subject, self.meta) for c in last]
+        return [len(r.commits) == len(last) and
+                all(r.by_key[key][0] == j
+                    for j, key in enumerate(keys) if key in r.by_key)
+                for r in self.ranges[:-1]]
+
+    def _find_cell(self, row: Row, ind: int,
+                   r_ind: int) -> Optional[GitHashCell]:
+        """Find commit for @row (which is @ind'th in the table) in range
+        @r_ind. Fallback to commit at same position, if the range is
+        considered corresponding, and then to commit, proposed by
+        match_by_content().
+        """
+        r = self.ranges[r_ind]
+        key = subject_to_key(row.subject, self.meta)
+        if key in r.by_key:
+            _, c2 = r.by_key[key]
+            in_tag = ''
+            if r_ind in (row.up_ind, row.new_ind):
+                in_tag = c2.in_tag
+            return GitHashCell(c2.commit_hash, in_tag=in_tag)
+
+        if self.corresponding[r_ind]:
+            return GitHashCell(r.commits[ind].commit_hash)
+
+        c2 = r.by_full_hash.get(self.proposed.get((r_ind, key)))
+        if c2 is not None:
+            in_tag = ''
+            if r_ind in (row.up_ind, row.new_ind):
+                in_tag = c2.in_tag
+            return GitHashCell(c2.commit_hash, in_tag=in_tag, proposed=True)
+
+        return None
+
+    def _make_row(self, ind: int) -> Row:
+        row = Row(self.ranges, ind, self.meta)
+        for r_ind in range(len(self.ranges) - 1):
+            row.commits[r_ind] = self._find_cell(row, ind, r_ind)
+
+        issues = self.issues_map.get(row.subject)
+        if issues:
+            row.issues = issues
+
+        return row
+
+    def update_range(self, r_ind: int, new_range: MultiRange,
+                     ignore_cmsg: bool, jobs: int = 1) -> None:
+        """Update the table after history of range @r_ind is rewritten
+
+        Only rows affected by changed commits (those after the common
+        prefix of old and new range) are updated and compared again, other
+        rows keep their cells and comparison results. Result is the same
+        as of the table built from scratch.
+        """
+        old = self.ranges[r_ind]
+        self.ranges[r_ind] = new_range
+        old_corresponding = self.corresponding
+        self.corresponding = self._find_corresponding()
+
+        prefix = 0
+        for c_old, c_new in zip(old.commits, new_range.commits):
+            if c_old.commit_hash != c_new.commit_hash:
+                break
+            prefix += 1
+
+        last = len(self.ranges) - 1
+        # Ranges, in which cells of kept rows may change
+        recheck = [i for i in range(last) if i == r_ind or
+                   self.corresponding[i] != old_corresponding[i]]
+
+        if r_ind == last:
+            del self.rows[prefix:]
+            kept = list(self.rows)
+            changed = [self._make_row(i)
+                       for i in range(prefix, len(new_range.commits))]
+            self.rows.extend(changed)
+        else:
+            kept = self.rows
+            changed = []
+
+        old_hashes = {c.commit_hash for c in old.commits[prefix:]}
+        for i, row in enumerate(kept):
+            row_changed = False
+            for k in recheck:
+                cell = row.commits[k]
+                new_cell = self._find_cell(row, i, k)
+                old_hash = cell.commit_hash if cell else None
+                new_hash = new_cell.commit_hash if new_cell else None
+                if old_hash == new_hash and \
+                        (k != r_ind or old_hash not in old_hashes):
+                    continue
+
+                row.commits[k] = new_cell
+                row_changed = True
+
+            if row_changed:
+                for c in row.commits:
+                    if c is not None:
+                        c.comp = CompRes.NONE
+                changed.append(row)
+
+        self.do_comparison(ignore_cmsg, jobs, rows=changed)
+
+    def match_by_content(self, threshold: float = 0.5) -> None:
+        """Fill empty cells by commits with similar changes
+
+        For each range, commits not found for some rows by subject are
+        searched among not yet matched commits of the range, by similarity
+        of changed lines. Found commits are marked as proposed.
+        """
+        full_id = get_cache().full_id
+        last = self.ranges[-1].commits
+        todo = []
+        for r_ind, r in enumerate(self.ranges[:-1]):
+            rows = [(last[i].full_hash, row) for i, row in enumerate(self.rows)
+                    if row.commits[r_ind] is None]
+            used = {full_id(row.commits[r_ind].commit_hash)
+                    for row in self.rows if row.commits[r_ind] is not None}
+            free = [c for c in r.commits if c.full_hash not in used]
+            if rows and free:
+                todo.append((r_ind, rows, free))
+
+        if not todo:
+            return
 
-            for j, row in enumerate(self.rows):
-                if row.commits[i] is None:
-                    c = ranges[i].commits[j]
-                    row.commits[i] = GitHashCell(c.commit_hash)
+        hashes = {c.full_hash for _, _, free in todo for c in free}
+        hashes.update(h for _, rows, _ in todo for h, _ in rows)
+        try:
+            lines = {full: changed_lines(patch)
+                     for full, _, _, patch in iter_commit_patches(hashes)}
+        except subprocess.CalledProcessError:
+            # Matching by content is only a hint
+            return
+
+        for r_ind, rows, free in todo:
+            by_hash = {c.full_hash: c for c in free}
+            found = match_similar(
+                {i: lines[h] for i, (h, _) in enumerate(rows)},
+                {h: lines[h] for h in by_hash}, threshold)
+
+            for i, h in found.items():
+                row = rows[i][1]
+                c = by_hash[h]
+                in_tag = ''
+                if r_ind in (row.up_ind, row.new_ind):
+                    in_tag = c.in_tag
+                row.commits[r_ind] = GitHashCell(c.commit_hash, in_tag=in_tag,
+                                                 proposed=True)
+                key = subject_to_key(row.subject, self.meta)
+                self.proposed[r_ind, key] = h
 
     @staticmethod
     def _compare_commits(base: GitHashCell, other: GitHashCell,
-                         row_meta: Optional[CommitMeta],
-                         ign_cmsg: bool) -> None:
+                         ign_cmsg: bool) -> bool:
         if are_commits_equal(base.commit_hash, other.commit_hash, ign_cmsg):
             other.comp = CompRes.EQUAL
             base.comp = CompRes.BASE
-            return
-
-        if row_meta is None:
-            return
+            return True
 
-        for a, b in row_meta.checked:
-            for x, y in ((a, b), (b, a)):
-                if are_commits_equal(x, other.commit_hash, ign_cmsg) and \
-                        are_commits_equal(y, base.commit_hash, ign_cmsg):
-                    other.comp = CompRes.CHECKED
-                    base.comp = CompRes.BASE
-                    return
+        return False
 
-    def do_comparison(self, ignore_cmsg: bool) -> None:
-        for row in self.rows:
+    def do_comparison(self, ignore_cmsg: bool, jobs: int = 1,
+                      rows: Optional[List[Row]] = None) -> None:
+        """Compare commits in each row with the base one
+        @jobs: how many git processes to run in parallel to load patches
+        @rows: if specified, compare only these rows
+        """
+        cells = []
+        for row in self.rows if rows is None else rows:
             base_ind = len(row.commits) - 1 if row.commits[0] is None else 0
             base = row.commits[base_ind]
             assert base is not None
@@ -345,21 +639,49 @@ class Table:
                 if c is None or i == base_ind:
                     continue
 
-                self._compare_commits(base, c, row.meta, ignore_cmsg)
+                cells.append((base, c, row.meta))
 
-    def add_porting_issues(self, issue_tracker, porting_issues):
-        if issue_tracker == 'jira':
-            from .gcr_jira import GCRTracer
-        else:
-            import importlib
-            mod, klass = issue_tracker.rsplit('.', 1)
-            GCRTracer = getattr(importlib.import_module(mod), klass)
+        # Load all needed patches in one go, not commit by commit
+        load_pairs_fingerprints(((base.commit_hash, c.commit_hash)
+                                 for base, c, _ in cells), jobs)
+
+        not_equal = [(base, c, row_meta) for base, c, row_meta in cells
+                     if not self._compare_commits(base, c, ignore_cmsg) and
+                     row_meta is not None and row_meta.checked]
+
+        load_fingerprints((h for base, c, row_meta in not_equal
+                           for h in chain((base.commit_hash, c.commit_hash),
+                                          *row_meta.checked)), jobs)
+
+        indexes: Dict[CommitMeta, CheckedIndex] = {}
+        for base, c, row_meta in not_equal:
+            if row_meta not in indexes:
+                indexes[row_meta] = CheckedIndex(row_meta.checked,
+                                                 ignore_cmsg)
+
+            if (c.commit_hash, base.commit_hash) in indexes[row_meta]:
+                c.comp = CompRes.CHECKED
+                base.comp = CompRes.BASE
+
+    def add_porting_issues(self, issue_tracker, porting_issues, jobs=1,
+                           cache_ttl=0, offline=False):
+        def load_tracker_class():
+            if issue_tracker == 'jira':
+                from .gcr_jira import GCRTracer
+            else:
+                import importlib
+                mod, klass = issue_tracker.rsplit('.', 1)
+                GCRTracer = getattr(importlib.import_module(mod), klass)
+
+            return GCRTracer
 
-        tracker = GCRTracer()
-        issues_map = parse_issues(tracker, porting_issues,
-                                  [r.subject for r in self.rows])
+        tracker = CachingTracker(load_tracker_class,
+                                 get_issue_cache(issue_tracker),
+                                 cache_ttl, offline, jobs)
+        self.issues_map = parse_issues(tracker, porting_issues,
+                                       [r.subject for r in self.rows], jobs)
         for row in self.rows:
-            issues = issues_map.get(row.subject)
+            issues = self.issues_map.get(row.subject)
             if issues:
                 row.issues = issues
 
@@ -1,9 +1,11 @@
-from typing import Iterable, Any
+from typing import Iterable, Any, List, Optional, Dict
 from getpass import getpass
 
 import jira  # type: ignore
 from jira.utils import json_loads  # type: ignore
 
+FIELDS = 'description,subtasks,priority,resolution,issuetype,updated'
+
 
 class GCRIssue:
     def __init__(self, tracker: 'GCRTracer', issue: Any) -> None:
@@ -18,6 +20,10 @@ class GCRIssue:
     def description(self):
         return self._issue.fields.description
 
+    @property
+    def updated(self):
+        return self._issue.fields.updated
+
     def is_critical(self) -> bool:
         return self._issue.fields.priority.name in ('Critical', 'Blocker')
 
@@ -25,17 +31,28 @@ class GCRIssue:
         resol = self._issue.fields.resolution
         return resol and resol.name == 'Fixed'
 
-    def get_subissues(self) -> Iterable['GCRIssue']:
-        if self._issue.fields.issuetype.name == 'Epic':
+    def is_epic(self) -> bool:
+        return self._issue.fields.issuetype.name == 'Epic'
+
+    def get_subissue_keys(self) -> List[str]:
+        if self.is_epic():
             path = f'/rest/agile/1.0/epic/{self.key}/issue'
             issues = self.tracker.get_json(path)['issues']
-            return (self.tracker.get_issue(iss['key']) for iss in issues)
+            return [iss['key'] for iss in issues]
 
-        return (GCRIssue(self.tracker, sub)
-                for sub in self._issue.fields.subtasks)
+        return [sub.key for sub in self._issue.fields.subtasks]
+
+    def get_subissues(self) -> Iterable['GCRIssue']:
+        return (self.tracker.get_issue(key)
+                for key in self.get_subissue_keys())
 
 
 class GCRTracer:
+    # Maximum number of keys in one JQL query and number of issues requested
+    # per page of search results
+    keys_per_query = 50
+    page_size = 100
+
     def __init__(self) -> None:
         server = input('Jira server: ')
         if not server.startswith('http'):
@@ -51,5 +68,79 @@ class GCRTracer:
         return json_loads(self._jira._session.get(url))
 
     def get_issue(self, key: str) -> GCRIssue:
-        fields = 'description,subtasks,priority,resolution,issuetype'
-        return GCRIssue(self, self._jira.issue(key, fields=fields))
+        return GCRIssue(self, self._jira.issue(key, fields=FIELDS))
+
+    def _search(self, jql: str, fields: str) -> List[Any]:
+        res: List[Any] = []
+        while True:
+            page = self._jira.search_issues(jql, startAt=len(res),
+                                            maxResults=self.page_size,
+                                            fields=fields)
+            res.extend(page)
+            if not page or len(res) >= page.total:
+                return res
+
+    def _search_in(self, field: str, keys: List[str], fields: str,
+                   order: str = '') -> List[Any]:
+        """Search issues with @field value in @keys"""
+        res = []
+        for i in range(0, len(keys), self.keys_per_query):
+            chunk = ', '.join(keys[i:i + self.keys_per_query])
+            res.extend(self._search(f'{field} in ({chunk}){order}', fields))
+        return res
+
+    def _epic_link_field(self) -> Optional[str]:
+        """Id of "Epic Link" custom field, None if there is no such field"""
+        if not hasattr(self, '_epic_link'):
+            self._epic_link = next((f['id'] for f in self._jira.fields()
+                                    if f['name'] == 'Epic Link'), None)
+        return self._epic_link
+
+    def get_issues(self, keys: List[str]) -> List[GCRIssue]:
+        return [GCRIssue(self, iss)
+                for iss in self._search_in('key', keys, FIELDS)]
+
+    def get_subissues_bulk(self, issues: List[GCRIssue]) -> \
+            Dict[str, List[GCRIssue]]:
+        """Load subissues of all @issues by several JQL searches
+
+        Returns {issue key => [subissues]}
+        """
+        res: Dict[str, List[GCRIssue]] = {issue.key: [] for issue in issues}
+
+        epic_link = self._epic_link_field()
+        epics = [issue.key for issue in issues
+                 if epic_link and issue.is_epic()]
+        if epics:
+            for iss in self._search_in('"Epic Link"', epics,
+                                       FIELDS + ',' + epic_link,
+                                       ' ORDER BY Rank'):
+                res[getattr(iss.fields, epic_link)].append(
+                    GCRIssue(self, iss))
+
+        # Subtasks, and issues of epics in projects without "Epic Link"
+        # (these are ordered by rank, like epic issues are returned by
+        # get_subissue_keys())
+        parents = [issue for issue in issues if issue.key not in epics]
+        if parents:
+            for iss in self._search_in('parent',
+                                       [issue.key for issue in parents],
+                                       FIELDS + ',parent', ' ORDER BY Rank'):
+                res[iss.fields.parent.key].append(GCRIssue(self, iss))
+
+        # Keep the order of subtasks of the parent
+        for issue in parents:
+            if not issue.is_epic():
+                order = {sub.key: i for i, sub in
+                         enumerate(issue._issue.fields.subtasks)}
+                res[issue.key].sort(
+                    key=lambda x: order.get(x.key, len(order)))
+
+        return res
+
+    def get_issue_updated(self, key: str) -> Optional[str]:
+        issue = self._jira.issue(key, fields='issuetype,updated')
+        if issue.fields.issuetype.name == 'Epic':
+            # Adding an issue to epic doesn't update the epic itself
+            return None
+        return issue.fields.updated
@@ -11,6 +11,7 @@ colors = {
     'base': 'green',
     'checked': 'orange',
     'in-tag': 'orange',
+    'proposed': 'DarkCyan',
     'drop': 'magenta',
     'none': None,
     None: None
@@ -23,6 +24,8 @@ class HtmlViewer(Viewer):
             'qemu/commits/' + h.commit_hash
         col = colors[h.comp.name.lower()]
         ret = f'<a href="{href}" style="color: {col}">{h.commit_hash}</a>'
+        if h.proposed:
+            ret += self.view_span(Span(' (similar)', 'proposed'))
         if h.in_tag:
             ret += self.view_span(Span(f' (in {h.in_tag})', 'in-tag'))
         return ret
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Iterable
+
+from .simple_git import git_get_cache_dir
+from .stats import STATS
+
+
+class CachedIssue:
+    """Issue, restored from IssueCache
+
+    Implements same interface as git_check_rebase.gcr_jira.GCRIssue.
+    """
+    def __init__(self, tracker: 'CachingTracker',
+                 data: Dict[str, Any]) -> None:
+        self.tracker = tracker
+        self.key = data['key']
+        self.description = data['description']
+        self.updated = data['updated']
+        self._subissue_keys = data['subissues']
+        self._critical = data['critical']
+        self._fixed = data['fixed']
+
+    def is_critical(self) -> bool:
+        return self._critical
+
+    def is_fixed(self) -> bool:
+        return self._fixed
+
+    def get_subissue_keys(self) -> List[str]:
+        return self._subissue_keys
+
+    def get_subissues(self) -> Iterable['CachedIssue']:
+        return (self.tracker.get_issue(key) for key in self._subissue_keys)
+
+
+class IssueCache:
+    """Persistent storage of issues, loaded from issue tracker
+
+    Issues are stored in sqlite database, keyed by tracker name and issue
+    key, together with the time when they were loaded.
+    """
+    timeout = 60
+
+    def __init__(self, fname: str, tracker_name: str) -> None:
+        self.fname = fname
+        self.tracker_name = tracker_name
+        self._lock = threading.Lock()
+
+        try:
+            self._db = self._connect(fname)
+        except sqlite3.DatabaseError as e:
+            print(f'Failed to open cache {fname}: {e}. '
+                  'Issues will not be saved.', file=sys.stderr)
+            self._db = self._connect(':memory:')
+
+    def _connect(self, fname: str) -> sqlite3.Connection:
+        db = sqlite3.connect(fname, timeout=self.timeout,
+                             check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS issue ('
+                       'tracker TEXT NOT NULL, key TEXT NOT NULL, '
+                       'loaded REAL NOT NULL, data TEXT NOT NULL, '
+                       'PRIMARY KEY (tracker, key)) WITHOUT ROWID')
+        return db
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Returns issue data with additional 'loaded' field"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT loaded, data FROM issue '
+                'WHERE tracker = ? AND key = ?',
+                (self.tracker_name, key)).fetchone()
+        if row is None:
+            return None
+
+        data = json.loads(row[1])
+        data['loaded'] = row[0]
+        return data
+
+    def add(self, key: str, data: Dict[str, Any]) -> None:
+        data = {k: v for k, v in data.items() if k != 'loaded'}
+        try:
+            with self._lock, self._db:
+                self._db.execute(
+                    'INSERT OR REPLACE INTO issue VALUES (?, ?, ?, ?)',
+                    (self.tracker_name, key, time.time(), json.dumps(data)))
+        except sqlite3.OperationalError as e:
+            print(f'Failed to update cache {self.fname}: {e}',
+                  file=sys.stderr)
+
+
+class CachingTracker:
+    """Issue tracker wrapper, which caches issues in IssueCache
+
+    Cached issue is used if it was loaded less than @ttl seconds ago.
+    Older issue is revalidated, if tracker implements optional
+    get_issue_updated(key) method (returning the value of "updated" field
+    of issue, or None if issue should be reloaded anyway) and issue
+    implements "updated" attribute: when it's unchanged, cached issue is
+    used. Otherwise issue is reloaded.
+
+    get_issues() loads not cached issues by up to @jobs parallel
+    get_issue() calls, or by bulk request, if tracker implements bulk
+    methods get_issues() and get_subissues_bulk(). Only in the latter case
+    get_subissues_bulk() is provided, so that parse_issues.load_issues()
+    falls back to parallel traversal for other trackers.
+
+    Tracker class is got by @load_class(), tracker is created on first
+    request. In @offline mode neither is done (so that module of the
+    tracker is not even imported), and only cached issues are available.
+    """
+    def __init__(self, load_class: Callable[[], type], cache: IssueCache,
+                 ttl: float, offline: bool = False, jobs: int = 1) -> None:
+        self._tracker_class = None if offline else load_class()
+        self._tracker: Optional[Any] = None
+        self._lock = threading.Lock()
+        self.cache = cache
+        self.ttl = ttl
+        self.offline = offline
+        self.jobs = jobs
+        # Subissue objects, got from get_subissues() or
+        # get_subissues_bulk() of loaded issues
+        self._subissues: Dict[str, Any] = {}
+
+        if self._is_bulk():
+            self.get_subissues_bulk = self._get_subissues_bulk
+
+    @property
+    def tracker(self) -> Any:
+        with self._lock:
+            if self._tracker is None:
+                self._tracker = self._tracker_class()
+            return self._tracker
+
+    def _is_bulk(self) -> bool:
+        return hasattr(self._tracker_class, 'get_issues') and \
+            hasattr(self._tracker_class, 'get_subissues_bulk')
+
+    def _is_valid(self, key: str, data: Dict[str, Any]) -> bool:
+        if self.offline or time.time() - data['loaded'] < self.ttl:
+            return True
+
+        if data['updated'] is None or \
+                not hasattr(self.tracker, 'get_issue_updated'):
+            return False
+
+        if self.tracker.get_issue_updated(key) != data['updated']:
+            return False
+
+        self.cache.add(key, data)
+        return True
+
+    def _get_cached(self, key: str) -> Optional[CachedIssue]:
+        data = self.cache.get(key)
+        valid = data is not None and self._is_valid(key, data)
+        STATS.cache_lookup('issue', valid)
+        if valid:
+            return CachedIssue(self, data)
+
+        if self.offline:
+            sys.exit(f'Issue {key} is not cached, '
+                     'can\'t load it in offline mode')
+
+        return None
+
+    def _pop_subissue(self, key: str) -> Optional[Any]:
+        with self._lock:
+            return self._subissues.pop(key, None)
+
+    def _save_subissues(self, subs: Iterable[Any]) -> None:
+        with self._lock:
+            self._subissues.update((sub.key, sub) for sub in subs)
+
+    def _store(self, key: str, issue: Any,
+               subissues: List[str]) -> CachedIssue:
+        data = {
+            'key': issue.key,
+            'description': issue.description,
+            'updated': getattr(issue, 'updated', None),
+            'subissues': subissues,
+            'critical': issue.is_critical(),
+            'fixed': bool(issue.is_fixed()),
+        }
+        self.cache.add(key, data)
+        return CachedIssue(self, data)
+
+    def _store_bulk(self, issues: Dict[str, Any]) -> List[CachedIssue]:
+        """Store issues, given as {key => issue}, loading their subissues
+        by one bulk request
+        """
+        subs = self.tracker.get_subissues_bulk(list(issues.values()))
+        for lst in subs.values():
+            self._save_subissues(lst)
+
+        return [self._store(key, issue,
+                            [sub.key for sub in subs.get(issue.key, [])])
+                for key, issue in issues.items()]
+
+    def get_issue(self, key: str) -> CachedIssue:
+        cached = self._get_cached(key)
+        if cached is not None:
+            return cached
+
+        return self._load_issue(key)
+
+    def _load_issue(self, key: str) -> CachedIssue:
+        """Load not cached issue"""
+        issue = self._pop_subissue(key)
+        if issue is None:
+            issue = self.tracker.get_issue(key)
+
+        if self._is_bulk():
+            return self._store_bulk({key: issue})[0]
+
+        if hasattr(issue, 'get_subissue_keys'):
+            return self._store(key, issue, issue.get_subissue_keys())
+
+        subs = list(issue.get_subissues())
+        self._save_subissues(subs)
+        return self._store(key, issue, [sub.key for sub in subs])
+
+    def get_issues(self, keys: List[str]) -> List[CachedIssue]:
+        res = []
+        missing = []
+        for key in dict.fromkeys(keys):
+            cached = self._get_cached(key)
+            if cached is None:
+                missing.append(key)
+            else:
+                res.append(cached)
+
+        if not missing:
+            return res
+
+        if not self._is_bulk():
+            with ThreadPoolExecutor(self.jobs) as pool:
+                return res + list(pool.map(self._load_issue, missing))
+
+        loaded = {}
+        to_load = []
+        for key in missing:
+            issue = self._pop_subissue(key)
+            if issue is None:
+                to_load.append(key)
+            else:
+                loaded[key] = issue
+        if to_load:
+            loaded.update((issue.key, issue) for issue in
+                          self.tracker.get_issues(to_load))
+
+        return res + self._store_bulk(loaded)
+
+    def _get_subissues_bulk(self, issues: List[CachedIssue]) -> \
+            Dict[str, List[CachedIssue]]:
+        keys = [k for issue in issues for k in issue.get_subissue_keys()]
+        loaded = {issue.key: issue for issue in self.get_issues(keys)}
+
+        return {issue.key: [loaded[k] for k in issue.get_subissue_keys()
+                            if k in loaded]
+                for issue in issues}
+
+
+def get_issue_cache(tracker_name: str) -> IssueCache:
+    return IssueCache(os.path.join(git_get_cache_dir(), 'issue-cache.db'),
+                      tracker_name)
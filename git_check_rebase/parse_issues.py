@@ -1,41 +1,161 @@
-from typing import Any, List, Dict, Set
+from typing import Any, List, Dict, Set, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor, Future, wait, \
+    FIRST_COMPLETED
 
 
-def parse_issue(issue: Any, commits: List[str],
-                result: Dict[str, List[Any]],
-                parsed_keys: Set[str]) -> None:
-    """Update @result: dict {commit => [list of matching issues]}"""
-    if issue.key in parsed_keys:
-        return
-    parsed_keys.add(issue.key)
+class SuffixMatcher:
+    """Find strings from fixed list, which are suffixes of given line
+
+    Strings are stored in a trie by reversed characters, so line is matched
+    in time proportional to its length, not to the number of strings.
+    """
+    def __init__(self, strings: List[str]) -> None:
+        self.strings = strings
+        # Node is a dict {character => child node}, and indices in
+        # @strings of strings ending at this node are stored by None key.
+        self._root: Dict[Optional[str], Any] = {}
+        for i, s in enumerate(strings):
+            node = self._root
+            for ch in reversed(s):
+                node = node.setdefault(ch, {})
+            node.setdefault(None, []).append(i)
+
+    def match(self, line: str) -> List[str]:
+        """Returns strings, which @line ends with, in order of @strings
 
+        Repeated strings are returned several times.
+        """
+        node = self._root
+        found = list(node.get(None, ()))
+        for ch in reversed(line):
+            node = node.get(ch)
+            if node is None:
+                break
+            found.extend(node.get(None, ()))
+
+        return [self.strings[i] for i in sorted(found)]
+
+
+def parse_issue(issue: Any, matcher: SuffixMatcher,
+                result: Dict[str, List[Any]]) -> None:
+    """Update @result: dict {commit => [list of matching issues]}"""
     if issue.description:
         for line in issue.description.split('\n'):
-            line = line.strip()
-            for commit in commits:
-                if line.endswith(commit):
-                    if commit in result:
-                        result[commit].append(issue)
-                    else:
-                        result[commit] = [issue]
+            for commit in matcher.match(line.strip()):
+                if commit in result:
+                    result[commit].append(issue)
+                else:
+                    result[commit] = [issue]
 
-    for sub in issue.get_subissues():
-        parse_issue(sub, commits, result, parsed_keys)
+
+def load_issue(tracker: Any, key: str, issue: Optional[Any]) -> \
+        Tuple[Any, List[Tuple[str, Optional[Any]]]]:
+    """Load issue (if not loaded yet) and list its subissues
+
+    Returns issue and list of (key, issue) for subissues. If tracker issue
+    class implements get_subissue_keys(), subissues are returned as
+    (key, None) to be loaded in parallel by get_issue(), otherwise subissue
+    objects are taken from get_subissues().
+    """
+    if issue is None:
+        issue = tracker.get_issue(key)
+
+    if hasattr(issue, 'get_subissue_keys'):
+        return issue, [(k, None) for k in issue.get_subissue_keys()]
+
+    return issue, [(sub.key, sub) for sub in issue.get_subissues()]
+
+
+def load_issues_bulk(tracker: Any, issues: List[str]) -> \
+        Tuple[Dict[str, Any], Dict[str, List[str]]]:
+    """Same as load_issues, but for tracker implementing bulk method
+    get_subissues_bulk(issues), returning {key => [subissues]} for all
+    @issues. It is called once per level of issues tree.
+    """
+    loaded: Dict[str, Any] = {}
+    children: Dict[str, List[str]] = {}
+
+    level = {key: tracker.get_issue(key) for key in dict.fromkeys(issues)}
+    seen = set(level) | {issue.key for issue in level.values()}
+
+    while level:
+        loaded.update(level)
+        subs = tracker.get_subissues_bulk(list(level.values()))
+
+        next_level = {}
+        for key, issue in level.items():
+            children[key] = [sub.key for sub in subs.get(issue.key, [])]
+            for sub in subs.get(issue.key, []):
+                if sub.key not in seen:
+                    seen.add(sub.key)
+                    next_level[sub.key] = sub
+        level = next_level
+
+    return loaded, children
+
+
+def load_issues(tracker: Any, issues: List[str], jobs: int = 1) -> \
+        Tuple[Dict[str, Any], Dict[str, List[str]]]:
+    """Load issues and all their subissues
+
+    Traversal is breadth-first, up to @jobs requests run in parallel, each
+    issue is requested only once.
+
+    Returns two dicts: {key => issue} and {key => [subissue keys]}
+    """
+    if hasattr(tracker, 'get_subissues_bulk'):
+        return load_issues_bulk(tracker, issues)
+
+    loaded: Dict[str, Any] = {}
+    children: Dict[str, List[str]] = {}
+    seen = set(issues)
+
+    with ThreadPoolExecutor(jobs) as pool:
+        running: Dict[Future, str] = {
+            pool.submit(load_issue, tracker, key, None): key
+            for key in dict.fromkeys(issues)}
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                key = running.pop(fut)
+                loaded[key], subs = fut.result()
+                children[key] = [k for k, _ in subs]
+                for k, sub in subs:
+                    if k not in seen:
+                        seen.add(k)
+                        running[pool.submit(load_issue, tracker, k, sub)] = k
+
+    return loaded, children
 
 
 def parse_issues(tracker: Any, issues: List[str],
-                 commits: List[str]) -> Dict[str, List[Any]]:
+                 commits: List[str], jobs: int = 1) -> Dict[str, List[Any]]:
     """Recursively search issues for commits mentioned in description
 
     Search issues (and their subtasks) for description lines, ends with commit
-    subjects from commits list
+    subjects from commits list. Issues are loaded by up to @jobs parallel
+    requests, but processed in depth-first order, so result doesn't depend
+    on @jobs.
 
     Returns dict {commit => [list of matching issues]}
     """
-    result: Dict[str, List[str]] = {}
+    result: Dict[str, List[Any]] = {}
     parsed_keys: Set[str] = set()
 
-    for issue in issues:
-        parse_issue(tracker.get_issue(issue), commits, result, parsed_keys)
+    loaded, children = load_issues(tracker, issues, jobs)
+    matcher = SuffixMatcher(commits)
+
+    for root in issues:
+        stack = [root]
+        while stack:
+            key = stack.pop()
+            issue = loaded[key]
+            if issue.key in parsed_keys:
+                continue
+            parsed_keys.add(issue.key)
+
+            parse_issue(issue, matcher, result)
+            stack.extend(reversed(children[key]))
 
     return result
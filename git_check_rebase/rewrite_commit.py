@@ -0,0 +1,330 @@
+import os
+import shlex
+import hashlib
+import subprocess
+from tempfile import TemporaryDirectory
+from typing import Optional, List, Tuple, Dict, Iterable
+
+from .simple_git import git, git_run, git_stream, git_rev_parse, \
+    git_cat_file
+
+# State of a path in a tree: (mode, object id), None if path is absent
+State = Optional[Tuple[str, str]]
+
+REGULAR_MODES = ('100644', '100755')
+
+
+class RewriteError(Exception):
+    """Commit can't be rewritten, nothing is changed
+
+    @retry: whether user may fix the patch and try again
+    """
+    def __init__(self, problem: str, retry: bool = True) -> None:
+        super().__init__(problem)
+        self.retry = retry
+
+
+def parse_raw_diff(pieces: Iterable[str]) -> \
+        Dict[str, Dict[str, Tuple[State, State]]]:
+    """Parse output of git diff-tree -r -z --no-renames
+
+    Returns dict {commit => {path => (old state, new state)}}, commit is
+    empty for output of diff-tree of two trees.
+    """
+    res: Dict[str, Dict[str, Tuple[State, State]]] = {}
+    changes = res.setdefault('', {})
+    pieces = iter(pieces)
+    for piece in pieces:
+        if piece.startswith(':'):
+            old_mode, new_mode, old_oid, new_oid, _ = piece[1:].split(' ')
+            changes[next(pieces)] = (
+                None if old_mode == '000000' else (old_mode, old_oid),
+                None if new_mode == '000000' else (new_mode, new_oid))
+        elif piece:
+            changes = res.setdefault(piece.strip(), {})
+
+    return res
+
+
+def read_commit(commit: str) -> Tuple[Dict[str, List[bytes]], bytes]:
+    """Returns headers of the commit object as {name => [values]} (values
+    of multiline headers are truncated to the first line) and raw commit
+    message
+    """
+    res = git_cat_file(commit)
+    if res is None or res[0] != 'commit':
+        raise RewriteError(f'failed to read commit {commit}', retry=False)
+
+    raw_headers, _, message = res[1].partition(b'\n\n')
+    headers: Dict[str, List[bytes]] = {}
+    for line in raw_headers.split(b'\n'):
+        if not line.startswith(b' '):
+            name, _, value = line.partition(b' ')
+            headers.setdefault(name.decode(), []).append(value)
+
+    return headers, message
+
+
+def linear_descendants(commit: str, top: str) -> List[str]:
+    """Returns commits from @commit (exclusive) to @top (inclusive), which
+    must be a linear history
+    """
+    chain: List[str] = []
+    parent = commit
+    for line in git(f'rev-list --reverse --parents {commit}..{top}') \
+            .splitlines():
+        c, *parents = line.split()
+        if parents != [parent]:
+            raise RewriteError('merge commits after the modified commit are '
+                               'not supported', retry=False)
+        chain.append(c)
+        parent = c
+
+    return chain
+
+
+def commit_email(parents: List[str], email: str, tmp: str) -> str:
+    """Create commit from @email patch on top of @parents, like git am does,
+    but using temporary index in @tmp directory instead of the working tree
+
+    Returns full id of the created commit.
+    """
+    msg_fname = os.path.join(tmp, 'msg')
+    patch_fname = os.path.join(tmp, 'patch')
+    try:
+        info = git(f'mailinfo {shlex.quote(msg_fname)} '
+                   f'{shlex.quote(patch_fname)}', input=email)
+    except subprocess.CalledProcessError as e:
+        raise RewriteError('git mailinfo failed') from e
+
+    fields = dict(line.split(': ', 1) for line in info.splitlines()
+                  if ': ' in line)
+    if 'Author' not in fields or 'Email' not in fields:
+        raise RewriteError('no author in the patch')
+
+    with open(msg_fname) as f:
+        body = f.read()
+    message = git('stripspace',
+                  input=fields.get('Subject', '') + '\n\n' + body)
+
+    env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp, 'index'))
+    git(f'read-tree {parents[0]}' if parents else 'read-tree --empty',
+        env=env)
+    if os.path.getsize(patch_fname):
+        try:
+            git(f'apply --cached {shlex.quote(patch_fname)}', env=env)
+        except subprocess.CalledProcessError as e:
+            raise RewriteError('git apply failed') from e
+    tree = git('write-tree', env=env).strip()
+
+    env = dict(os.environ, GIT_AUTHOR_NAME=fields['Author'],
+               GIT_AUTHOR_EMAIL=fields['Email'])
+    if 'Date' in fields:
+        env['GIT_AUTHOR_DATE'] = fields['Date']
+
+    try:
+        return git(f'commit-tree {tree}' +
+                   ''.join(f' -p {p}' for p in parents),
+                   input=message, env=env).strip()
+    except subprocess.CalledProcessError as e:
+        # Most probably, bad author in the patch
+        raise RewriteError('git commit-tree failed') from e
+
+
+def blob_id(content: bytes, like: str) -> str:
+    """Calculate id of blob with @content, using same hash as for @like"""
+    h = hashlib.sha1() if len(like) == 40 else hashlib.sha256()
+    h.update(b'blob %d\0' % len(content))
+    h.update(content)
+    return h.hexdigest()
+
+
+def read_blob(oid: str, blobs: Dict[str, bytes]) -> bytes:
+    if oid in blobs:
+        return blobs[oid]
+
+    res = git_cat_file(oid)
+    if res is None:
+        raise RewriteError(f'failed to read blob {oid}', retry=False)
+    return res[1]
+
+
+def merge_states(base: State, ours: State, theirs: State,
+                 blobs: Dict[str, bytes], tmp: str) -> State:
+    """Three-way merge of path states, raises ValueError on conflict
+
+    Merged file contents are added to @blobs as {id => content}.
+    """
+    if ours == theirs or theirs == base:
+        return ours
+    if ours == base:
+        return theirs
+    if base is None or ours is None or theirs is None or \
+            any(s[0] not in REGULAR_MODES for s in (base, ours, theirs)):
+        raise ValueError
+
+    if ours[0] == base[0]:
+        mode = theirs[0]
+    elif theirs[0] in (base[0], ours[0]):
+        mode = ours[0]
+    else:
+        raise ValueError
+
+    if ours[1] == base[1]:
+        return mode, theirs[1]
+    if theirs[1] in (base[1], ours[1]):
+        return mode, ours[1]
+
+    fnames = []
+    for name, state in (('ours', ours), ('base', base), ('theirs', theirs)):
+        fname = os.path.join(tmp, name)
+        with open(fname, 'wb') as f:
+            f.write(read_blob(state[1], blobs))
+        fnames.append(fname)
+
+    p = git_run(['merge-file', '-p', '-q'] + fnames,
+                stdout=subprocess.PIPE, check=False)
+    if p.returncode:
+        raise ValueError
+
+    oid = blob_id(p.stdout, base[1])
+    blobs[oid] = p.stdout
+    return mode, oid
+
+
+def fast_import_path(path: str) -> bytes:
+    if path.startswith('"') or '\n' in path:
+        path = '"' + path.replace('\\', '\\\\').replace('"', '\\"') \
+            .replace('\n', '\\n') + '"'
+    return path.encode()
+
+
+def fast_import_data(content: bytes) -> bytes:
+    return b'data %d\n%s\n' % (len(content), content)
+
+
+def replay(chain: List[str], old_base: str, new_base: str, tmp: str) -> str:
+    """Replay @chain of commits, based on @old_base, onto @new_base
+
+    Paths changed only by chain commits are just taken from them, paths
+    changed both by the chain and by @new_base (relatively to @old_base)
+    are merged by git merge-file. New commits are created by one
+    git fast-import run.
+
+    Returns full id of the new top commit.
+    """
+    if not chain:
+        return new_base
+
+    # Paths, which differ in new and old history, with their new state
+    delta = {path: new for path, (_, new) in parse_raw_diff(git_stream(
+        f'diff-tree -r -z --no-renames {old_base} {new_base}'))[''].items()}
+    changes = parse_raw_diff(git_stream(
+        'diff-tree -r -z --no-renames --stdin',
+        input=''.join(f'{c}\n' for c in chain)))
+    committer = git('var GIT_COMMITTER_IDENT').strip()
+    ref = f'refs/check-rebase/rewrite-{os.getpid()}'
+    blobs: Dict[str, bytes] = {}
+
+    stream = []
+    for c in chain:
+        headers, message = read_commit(c)
+        stream.append(b'commit %s\nauthor %s\ncommitter %s\n' %
+                      (ref.encode(), headers['author'][0],
+                       committer.encode()))
+        if 'encoding' in headers:
+            stream.append(b'encoding %s\n' % headers['encoding'][0])
+        stream.append(fast_import_data(message))
+        if c == chain[0]:
+            stream.append(f'from {new_base}\n'.encode())
+
+        for path, (old, theirs) in changes.get(c, {}).items():
+            state = theirs
+            if path in delta:
+                try:
+                    state = merge_states(old, delta[path], theirs, blobs, tmp)
+                except ValueError as e:
+                    raise RewriteError(f'conflict in {path} when replaying '
+                                       f'{c[:12]}') from e
+                if state == theirs:
+                    del delta[path]
+                else:
+                    delta[path] = state
+
+            if state is None:
+                stream.append(b'D %s\n' % fast_import_path(path))
+            elif state[1] in blobs:
+                stream.append(b'M %s inline %s\n' %
+                              (state[0].encode(), fast_import_path(path)))
+                stream.append(fast_import_data(blobs[state[1]]))
+            else:
+                stream.append(f'M {state[0]} {state[1]} '.encode() +
+                              fast_import_path(path) + b'\n')
+
+    try:
+        git_run(['fast-import', '--quiet'], input=b''.join(stream),
+                check=True)
+        return git_rev_parse(ref)
+    except subprocess.CalledProcessError as e:
+        raise RewriteError('git fast-import failed', retry=False) from e
+    finally:
+        try:
+            git(f'update-ref -d {ref}')
+        except subprocess.CalledProcessError:
+            # Leftover temporary ref is harmless
+            pass
+
+
+def update_branch(branch: str, old_top: str, new_top: str,
+                  reason: str) -> None:
+    """Move @branch, which must be checked out, from @old_top to @new_top,
+    updating index and working tree only in changed paths
+    """
+    try:
+        git(f'read-tree -m -u {old_top} {new_top}')
+    except subprocess.CalledProcessError as e:
+        raise RewriteError('failed to update working tree',
+                           retry=False) from e
+
+    try:
+        git(f'update-ref -m {shlex.quote(reason)} refs/heads/{branch} '
+            f'{new_top} {old_top}')
+    except subprocess.CalledProcessError as e:
+        git(f'read-tree -m -u {new_top} {old_top}')
+        raise RewriteError(f'{branch} is changed by somebody else',
+                           retry=False) from e
+
+
+def rewrite_commit(commit: str, branch: str, email: str) -> str:
+    """Replace @commit of checked out @branch by commit, created from
+    @email patch (as produced by git show --format=email), and rebase
+    following commits of @branch onto it
+
+    Nothing is checked out: new commits are created in the object database
+    and the branch is updated by one ref update at the end, so on failure
+    (RewriteError is raised) nothing is changed.
+
+    Returns full id of the new commit.
+    """
+    old_top = git_rev_parse(f'refs/heads/{branch}')
+    full = git_rev_parse(commit + '^{commit}')
+    if old_top is None or full is None:
+        raise RewriteError(f'failed to resolve {commit} and {branch}',
+                           retry=False)
+
+    headers, _ = read_commit(full)
+    parents = [p.decode() for p in headers.get('parent', [])]
+    if len(parents) > 1:
+        raise RewriteError('modifying merge commits is not supported',
+                           retry=False)
+
+    chain = linear_descendants(full, old_top)
+    with TemporaryDirectory(prefix='git-check-rebase-') as tmp:
+        new = commit_email(parents, email, tmp)
+        new_top = replay(chain, full, new, tmp)
+
+    if new_top != old_top:
+        update_branch(branch, old_top, new_top,
+                      f'check-rebase: rewrite {full[:12]}')
+
+    return new
@@ -0,0 +1,120 @@
+import random
+import hashlib
+from typing import Set, List, Tuple, Dict, Iterable, Hashable, \
+    FrozenSet
+
+NUM_HASHES = 64
+BAND_SIZE = 4
+
+_PRIME = (1 << 61) - 1
+_rng = random.Random(0)
+_COEFFS = [(_rng.randrange(1, _PRIME), _rng.randrange(_PRIME))
+           for _ in range(NUM_HASHES)]
+
+Shingles = FrozenSet[str]
+
+
+def changed_lines(patch: str) -> Shingles:
+    """Set of added and removed lines of the patch, with +/- sign kept and
+    whitespace stripped. Empty lines are ignored.
+    """
+    res = set()
+    in_hunk = False
+    for line in patch.split('\n'):
+        if line.startswith('@@'):
+            in_hunk = True
+        elif line.startswith('diff '):
+            in_hunk = False
+        elif in_hunk and line[:1] in ('+', '-'):
+            stripped = line[1:].strip()
+            if stripped:
+                res.add(line[0] + stripped)
+
+    return frozenset(res)
+
+
+def minhash(shingles: Shingles) -> Tuple[int, ...]:
+    values = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'),
+                                             digest_size=8).digest(),
+                             'little') for s in shingles]
+    return tuple(min((a * v + b) % _PRIME for v in values)
+                 for a, b in _COEFFS)
+
+
+def jaccard(a: Shingles, b: Shingles) -> float:
+    return len(a & b) / len(a | b)
+
+
+class SimilarityIndex:
+    """Index of shingle sets (like sets of changed lines of commits)
+
+    To avoid comparing all pairs, MinHash signatures of the sets are
+    bucketed by bands (locality-sensitive hashing), so that only sets
+    sharing some bucket are compared exactly.
+    """
+    def __init__(self) -> None:
+        self._sets: Dict[Hashable, Shingles] = {}
+        self._buckets: Dict[Tuple[int, Tuple[int, ...]],
+                            List[Hashable]] = {}
+
+    @staticmethod
+    def _bands(shingles: Shingles) -> Iterable[Tuple[int, Tuple[int, ...]]]:
+        sig = minhash(shingles)
+        return ((i, sig[i:i + BAND_SIZE])
+                for i in range(0, NUM_HASHES, BAND_SIZE))
+
+    def add(self, item: Hashable, shingles: Shingles) -> None:
+        if not shingles:
+            return
+
+        self._sets[item] = shingles
+        for band in self._bands(shingles):
+            self._buckets.setdefault(band, []).append(item)
+
+    def query(self, shingles: Shingles,
+              threshold: float) -> List[Tuple[float, Hashable]]:
+        """Returns list of (similarity, item) for items with similarity not
+        less than @threshold
+        """
+        if not shingles:
+            return []
+
+        candidates: Set[Hashable] = set()
+        for band in self._bands(shingles):
+            candidates.update(self._buckets.get(band, ()))
+
+        res = []
+        for item in candidates:
+            sim = jaccard(shingles, self._sets[item])
+            if sim >= threshold:
+                res.append((sim, item))
+
+        return res
+
+
+def match_similar(left: Dict[Hashable, Shingles],
+                  right: Dict[Hashable, Shingles],
+                  threshold: float = 0.5) -> Dict[Hashable, Hashable]:
+    """Match items of @left and @right one-to-one by similarity of their
+    shingles, most similar pairs first.
+
+    Returns dict {left item: right item}
+    """
+    index = SimilarityIndex()
+    for item, shingles in right.items():
+        index.add(item, shingles)
+
+    r_pos = {item: i for i, item in enumerate(right)}
+    pairs = [(-sim, l_pos, r_pos[r_item], l_item, r_item)
+             for l_pos, (l_item, shingles) in enumerate(left.items())
+             for sim, r_item in index.query(shingles, threshold)]
+    pairs.sort(key=lambda x: x[:3])
+
+    res: Dict[Hashable, Hashable] = {}
+    used: Set[Hashable] = set()
+    for *_, l_item, r_item in pairs:
+        if l_item not in res and r_item not in used:
+            res[l_item] = r_item
+            used.add(r_item)
+
+    return res
@@ -1,11 +1,117 @@
+import os
 import sys
+import shlex
+import functools
+import atexit
+import threading
+import contextlib
 import subprocess
+from typing import Iterable, Iterator, Optional, Tuple, List, Dict
+
+from .stats import STATS
 
 
 def git(cmd, **args):
-    return subprocess.run('git ' + cmd, shell=True, encoding='utf-8',
-                          check=True, stdout=subprocess.PIPE,
-                          **args).stdout
+    with STATS.git_call(cmd):
+        return subprocess.run(['git'] + shlex.split(cmd), encoding='utf-8',
+                              check=True, stdout=subprocess.PIPE,
+                              **args).stdout
+
+
+def git_run(args: List[str], **kwargs) -> subprocess.CompletedProcess:
+    """Same as subprocess.run() of git with @args, but accounted in
+    statistics
+
+    For commands, which need binary input or output, or exit code instead
+    of exception, unlike git().
+    """
+    with STATS.git_call(' '.join(args)):
+        return subprocess.run(['git'] + args, **kwargs)
+
+
+def git_stream(cmd: str, sep: str = '\0', input: Optional[str] = None,
+               **args) -> Iterator[str]:
+    """Run git command and yield its output split by @sep
+
+    Output is read block by block, so each record is yielded as soon as it
+    is produced, and the whole output is never kept in memory.
+    Generator must be consumed up to the end. For statistics, time of the
+    command includes processing of its output by the caller.
+    """
+    with STATS.git_call(cmd):
+        yield from _git_stream(cmd, sep, input, **args)
+
+
+def _feed_input(stdin, input: str) -> None:
+    try:
+        with stdin:
+            stdin.write(input)
+    except BrokenPipeError:
+        # git exited without reading all the input, exit code tells why
+        pass
+
+
+@contextlib.contextmanager
+def _git_process(cmd: str, input: Optional[str],
+                 **args) -> Iterator[subprocess.Popen]:
+    """Start git command, feed it with @input and check its exit code"""
+    stdin = None if input is None else subprocess.PIPE
+    with subprocess.Popen(['git'] + shlex.split(cmd), stdin=stdin,
+                          stdout=subprocess.PIPE, **args) as p:
+        # Input is written by separate thread: commands like
+        # diff-tree --stdin produce output while reading input, so writing
+        # all of it before reading output deadlocks when both pipes are full
+        writer = None
+        if input is not None:
+            writer = threading.Thread(target=_feed_input,
+                                      args=(p.stdin, input), daemon=True)
+            writer.start()
+
+        yield p
+
+        if writer is not None:
+            writer.join()
+
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, 'git ' + cmd)
+
+
+def _git_stream(cmd: str, sep: str, input: Optional[str],
+                **args) -> Iterator[str]:
+    with _git_process(cmd, input, encoding='utf-8', **args) as p:
+        pieces = []
+        for block in iter(lambda: p.stdout.read(1 << 16), ''):
+            *records, last = block.split(sep)
+            if records:
+                pieces.append(records[0])
+                yield ''.join(pieces)
+                yield from records[1:]
+                pieces = []
+            pieces.append(last)
+
+        yield ''.join(pieces)
+
+
+def git_stream_pieces(cmd: str, sep: str = '\0',
+                      input: Optional[str] = None,
+                      **args) -> Iterator[Tuple[str, bool]]:
+    """Same as git_stream(), but records are not joined
+
+    Yields tuples (piece, last), where pieces of one record come in order,
+    and @last is True for the final piece of the record. So, huge records
+    (like patches) may be processed with memory usage not depending on
+    their size.
+    """
+    with STATS.git_call(cmd):
+        with _git_process(cmd, input, encoding='utf-8', **args) as p:
+            for block in iter(lambda: p.stdout.read(1 << 16), ''):
+                *records, last = block.split(sep)
+                for record in records:
+                    yield record, True
+                if last:
+                    yield last, False
+
+            yield '', True
 
 
 def git_log1(fmt, rev):
@@ -36,5 +142,167 @@ def git_log_table(fmt, param, splitter='$%^@'):
     return (line.split(splitter) for line in lines if line)
 
 
+def git_log_records(fields: List[str], param: str,
+                    input: Optional[str] = None) -> Iterator[List[str]]:
+    """Same as git_log_table, but fields are NUL-separated
+
+    So, fields may contain any text, like full commit message (%B).
+    @input is passed to git stdin (use with --stdin in @param).
+    """
+    cmd = "log -z --reverse --date=format:'%d.%m.%y %H:%M' " \
+        "'--pretty=format:{}' {}".format('%x00'.join(fields), param)
+
+    try:
+        values = list(git_stream(cmd, input=input))
+    except subprocess.CalledProcessError:
+        # assume, git will print error message
+        sys.exit(f'git {cmd} failed')
+
+    # With -z and --pretty=format: NUL separates records, it doesn't
+    # terminate them, so there are exactly len(fields) values per record.
+    # The only exception is empty output, which is split into one empty
+    # value: "- 1" skips it.
+    return (values[i:i + len(fields)]
+            for i in range(0, len(values) - 1, len(fields)))
+
+
+def git_abbrev_commits(commits: Iterable[str]) -> Dict[str, str]:
+    """Map full ids of @commits to abbreviated ones, by one git process"""
+    stdin = ''.join(c + '\n' for c in commits)
+    if not stdin:
+        return {}
+
+    out = git("log --no-walk=unsorted --stdin --format='%H %h'", input=stdin)
+    return dict(line.split() for line in out.splitlines())
+
+
+def git_is_ancestor(ancestor: str, descendant: str) -> bool:
+    try:
+        git(f'merge-base --is-ancestor {ancestor} {descendant}')
+        return True
+    except subprocess.CalledProcessError:
+        # not an ancestor (or bad revision)
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def git_commit_tags() -> Dict[str, List[str]]:
+    """Map commit id to names of tags, pointing to it"""
+    try:
+        out = git('show-ref --tags -d')
+    except subprocess.CalledProcessError:
+        # no tags
+        return {}
+
+    targets = {}
+    for line in out.splitlines():
+        oid, ref = line.split(' ', 1)
+        name = ref[len('refs/tags/'):]
+        if name.endswith('^{}'):
+            # peeled annotated tag
+            name = name[:-3]
+        targets[name] = oid
+
+    res: Dict[str, List[str]] = {}
+    for name, oid in targets.items():
+        res.setdefault(oid, []).append(name)
+
+    return res
+
+
 def git_get_git_dir():
     return git('rev-parse --git-common-dir').strip()
+
+
+@functools.lru_cache(maxsize=None)
+def git_get_cache_dir() -> str:
+    """Directory for git-check-rebase caches
+
+    It is $GIT_CHECK_REBASE_CACHE_DIR if set, otherwise check-rebase.cacheDir
+    git config variable if set, otherwise git common directory. Pointing
+    several clones of one project to the same directory makes them share
+    the caches.
+    """
+    path = os.environ.get('GIT_CHECK_REBASE_CACHE_DIR')
+    if not path:
+        try:
+            path = git('config --type=path --get check-rebase.cacheDir',
+                       stderr=subprocess.DEVNULL).strip()
+        except subprocess.CalledProcessError:
+            # variable is not set
+            pass
+
+    if not path:
+        return git_get_git_dir()
+
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class CatFile:
+    """Long-living "git cat-file --batch" or "--batch-check" process
+
+    The process is started on first request and is reused for all the
+    following ones, so reading an object doesn't cost a process spawn.
+    """
+    def __init__(self, mode: str = 'batch') -> None:
+        assert mode in ('batch', 'batch-check')
+        self.mode = mode
+        self._proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+
+    def _request(self, rev: str) -> Optional[Tuple[str, str, bytes]]:
+        if self._proc is None:
+            self._proc = subprocess.Popen(
+                ['git', 'cat-file', '--' + self.mode],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            atexit.register(self.close)
+
+        self._proc.stdin.write(rev.encode('utf-8') + b'\n')
+        self._proc.stdin.flush()
+
+        header = self._proc.stdout.readline().decode('utf-8').split()
+        if len(header) != 3:
+            # "<rev> missing" or "<rev> ambiguous"
+            return None
+
+        oid, obj_type, size = header
+        data = b''
+        if self.mode == 'batch':
+            data = self._proc.stdout.read(int(size))
+            self._proc.stdout.read(1)  # trailing newline
+
+        return oid, obj_type, data
+
+    def request(self, rev: str) -> Optional[Tuple[str, str, bytes]]:
+        """Returns (object id, object type, content) or None if not found.
+        For batch-check mode content is always empty.
+        """
+        if not rev or rev.strip() != rev or '\n' in rev:
+            return None
+
+        with self._lock, STATS.git_call('cat-file --' + self.mode):
+            return self._request(rev)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._proc is not None:
+                self._proc.stdin.close()
+                self._proc.wait()
+                self._proc = None
+
+
+CAT_FILE = CatFile()
+CAT_FILE_CHECK = CatFile('batch-check')
+
+
+def git_rev_parse(rev: str) -> Optional[str]:
+    """Get full object id of @rev or None if it is not found"""
+    res = CAT_FILE_CHECK.request(rev)
+    return None if res is None else res[0]
+
+
+def git_cat_file(rev: str) -> Optional[Tuple[str, bytes]]:
+    """Get type and content of object @rev or None if it is not found"""
+    res = CAT_FILE.request(rev)
+    return None if res is None else res[1:]
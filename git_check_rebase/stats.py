@@ -0,0 +1,173 @@
+"""Run statistics: git calls, cache hits and stage times
+
+Collection is disabled by default, then each event costs only a method call
+and one attribute check (no context manager is created for git commands).
+Enable it by STATS.enabled = True before the run.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, \
+    Optional, TextIO
+
+# Stage hook is called with stage name and returns context manager, which
+# wraps the stage
+StageHook = Callable[[str], ContextManager]
+
+# Stateless, so may be shared by all not measured git commands
+NO_STATS = nullcontext()
+
+
+class Stats:
+    def __init__(self) -> None:
+        self.enabled = False
+        self._lock = threading.Lock()
+        # kind => [count, seconds]
+        self.git: Dict[str, List[float]] = {}
+        # name => [hits, misses]
+        self.caches: Dict[str, List[int]] = {}
+        # name => {'wall': seconds, 'cpu': seconds, 'children_cpu': seconds}
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.hooks: Dict[str, StageHook] = {}
+
+    def add_git_call(self, cmd: str, seconds: float) -> None:
+        """Account git command @cmd (without "git"), which took @seconds"""
+        kind = cmd.split(None, 1)[0] if cmd.strip() else ''
+        with self._lock:
+            rec = self.git.setdefault(kind, [0, 0.0])
+            rec[0] += 1
+            rec[1] += seconds
+
+    def cache_lookups(self, name: str, hits: int, misses: int) -> None:
+        """Account @hits and @misses of cache @name"""
+        if not self.enabled:
+            return
+
+        with self._lock:
+            rec = self.caches.setdefault(name, [0, 0])
+            rec[0] += hits
+            rec[1] += misses
+
+    def git_call(self, cmd: str) -> ContextManager:
+        """Time git command @cmd (without "git")
+
+        Other external commands (like vim) are accounted the same way, by
+        their name.
+        """
+        if not self.enabled:
+            return NO_STATS
+
+        return self._git_call(cmd)
+
+    @contextmanager
+    def _git_call(self, cmd: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_git_call(cmd, time.perf_counter() - start)
+
+    def cache_lookup(self, name: str, hit: bool) -> None:
+        self.cache_lookups(name, int(hit), int(not hit))
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Measure wall time, CPU time of the process and CPU time of
+        finished subprocesses (mostly git) for stage @name. If hook is set
+        for the stage by set_hook(), the stage is run inside it.
+        """
+        if not self.enabled and name not in self.hooks:
+            yield
+            return
+
+        hook = self.hooks.get(name)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        t = os.times()
+        children = t.children_user + t.children_system
+        try:
+            if hook is None:
+                yield
+            else:
+                with hook(name):
+                    yield
+        finally:
+            t = os.times()
+            rec = self.stages.setdefault(
+                name, {'wall': 0.0, 'cpu': 0.0, 'children_cpu': 0.0})
+            rec['wall'] += time.perf_counter() - wall
+            rec['cpu'] += time.process_time() - cpu
+            rec['children_cpu'] += \
+                t.children_user + t.children_system - children
+
+    def set_hook(self, stage: str, hook: StageHook) -> None:
+        """Run @stage inside hook(stage) context manager, which may attach
+        a profiler, for example
+        """
+        self.hooks[stage] = hook
+
+    def to_json(self) -> Dict[str, Any]:
+        return {
+            'stages': self.stages,
+            'git': {kind: {'count': c, 'seconds': s}
+                    for kind, (c, s) in self.git.items()},
+            'caches': {name: {'hits': h, 'misses': m}
+                       for name, (h, m) in self.caches.items()},
+        }
+
+    def report(self, file: TextIO = sys.stderr) -> None:
+        print(f'{"Stages":24}{"wall":>10}{"cpu":>10}{"git cpu":>10}',
+              file=file)
+        for name, rec in self.stages.items():
+            print(f'  {name:22}{rec["wall"]:10.3f}{rec["cpu"]:10.3f}'
+                  f'{rec["children_cpu"]:10.3f}', file=file)
+
+        print(f'{"Git commands":24}{"count":>10}{"seconds":>10}', file=file)
+        for kind, (count, seconds) in sorted(self.git.items(),
+                                             key=lambda x: -x[1][1]):
+            print(f'  {kind:22}{count:10}{seconds:10.3f}', file=file)
+
+        print(f'{"Caches":24}{"hits":>10}{"misses":>10}', file=file)
+        for name, (hits, misses) in self.caches.items():
+            print(f'  {name:22}{hits:10}{misses:10}', file=file)
+
+    def save(self, fname: str) -> None:
+        """Write statistics to @fname as JSON"""
+        with open(fname, 'w') as f:
+            json.dump(self.to_json(), f, indent=2)
+
+
+STATS = Stats()
+
+
+def cprofile_hook(output: Optional[str] = None,
+                  limit: int = 30) -> StageHook:
+    """Stage hook to run the stage under cProfile
+
+    Profile is dumped to @output file (to be read by pstats module or
+    visualization tools), or, if @output is None, @limit top functions by
+    cumulative time are printed to stderr.
+    """
+    @contextmanager
+    def hook(name: str) -> Iterator[None]:
+        import cProfile
+        import pstats
+
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            if output is None:
+                print(f'Profile of stage {name}:', file=sys.stderr)
+                pstats.Stats(prof, stream=sys.stderr) \
+                    .sort_stats('cumulative').print_stats(limit)
+            else:
+                prof.dump_stats(output)
+
+    return hook
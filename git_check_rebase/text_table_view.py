@@ -1,9 +1,5 @@
-import tabulate  # type: ignore
-
 from .viewable import Viewer, Span, GitHashCell, ConvertedTable
 
-tabulate.PRESERVE_WHITESPACE = True
-
 colors = {
     'bug-critical': 'red',
     'bug-fixed': 'green',
@@ -14,6 +10,7 @@ colors = {
     'base': 'green',
     'checked': 'yellow',
     'in-tag': 'yellow',
+    'proposed': 'cyan',
     'drop': 'magenta',
     'none': None,
     None: None
@@ -32,6 +29,8 @@ class TextViewer(Viewer):
 
     def view_git_hash(self, h: GitHashCell) -> str:
         ret = self.styled(h.commit_hash, h.comp.name.lower())
+        if h.proposed:
+            ret += self.styled(' (similar)', 'proposed')
         if h.in_tag:
             ret += self.styled(f' (in {h.in_tag})', 'in-tag')
         return ret
@@ -40,4 +39,7 @@ class TextViewer(Viewer):
         return self.styled(s.text, s.klass)
 
     def view_converted_table(self, tab: ConvertedTable) -> str:
+        # tabulate is imported here, as importing it is rather slow
+        import tabulate  # type: ignore
+        tabulate.PRESERVE_WHITESPACE = True
         return tabulate.tabulate(tab, tablefmt='plain')
@@ -21,10 +21,13 @@ class CompRes(Enum):
 
 @dataclass
 class GitHashCell:
-    """Representation of one cell with commit hash"""
+    """Representation of one cell with commit hash
+    @proposed: commit is found by similar changes, not by subject
+    """
     commit_hash: str
     comp: CompRes = CompRes.NONE
     in_tag: str = ''
+    proposed: bool = False
 
 
 Viewable = Union[None, str, Span, GitHashCell]
@@ -39,6 +42,8 @@ class Viewer:
 
     def view_git_hash(self, h: GitHashCell) -> str:
         ret = h.commit_hash
+        if h.proposed:
+            ret += ' (similar)'
         if h.in_tag:
             ret += f' (in {h.in_tag})'
         return ret
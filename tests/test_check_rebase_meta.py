@@ -0,0 +1,201 @@
+import os
+import stat
+import time
+import shutil
+import unittest
+import importlib.util
+import importlib.machinery
+from unittest import mock
+from tempfile import mkdtemp
+
+from git_check_rebase import simple_git
+from git_check_rebase.check_rebase_meta import Meta, write_file_atomic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+META = '''\
+# comment
+%feature: feature-a
+subj A
+  old comment
+subj B
+%end
+
+subj C
+=subj C old
+
+subj F #ABC-1234
+  ok: h3 h4
+'''
+
+
+def load_script():
+    """Import git-check-rebase script as a module"""
+    loader = importlib.machinery.SourceFileLoader(
+        'git_check_rebase_script', os.path.join(ROOT, 'git-check-rebase'))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+class MetaTestCase(unittest.TestCase):
+    """Base class, which creates meta file in temporary directory, and
+    keeps the cache there too
+    """
+    def setUp(self) -> None:
+        self.tmp = mkdtemp(prefix='gcr-test-')
+        env = mock.patch.dict(os.environ, GIT_CHECK_REBASE_CACHE_DIR=self.tmp)
+        env.start()
+        self.addCleanup(env.stop)
+        simple_git.git_get_cache_dir.cache_clear()
+
+        self.fname = os.path.join(self.tmp, 'meta')
+        with open(self.fname, 'w') as f:
+            f.write(META)
+
+    def tearDown(self) -> None:
+        simple_git.git_get_cache_dir.cache_clear()
+        shutil.rmtree(self.tmp)
+
+    def read(self) -> str:
+        with open(self.fname) as f:
+            return f.read()
+
+
+class TestMetaFlush(MetaTestCase):
+    def test_flush_every(self) -> None:
+        meta = Meta(self.fname)
+        for i in range(meta.flush_every - 1):
+            meta.update_meta('subj A', f'comment {i}')
+        self.assertEqual(self.read(), META)
+
+        meta.update_meta('subj B', 'comment B', ('h1', 'h2'))
+        text = self.read()
+        self.assertIn(f'subj A\n  comment {meta.flush_every - 2}\n', text)
+        self.assertIn('subj B\n  comment B\n  ok: h1 h2\n', text)
+        self.assertNotIn('old comment', text)
+
+    def test_flush_interval(self) -> None:
+        meta = Meta(self.fname)
+        start = time.monotonic()
+
+        with mock.patch('time.monotonic',
+                        return_value=start + meta.flush_interval - 1):
+            meta.update_meta('subj A', 'first')
+        self.assertEqual(self.read(), META)
+
+        with mock.patch('time.monotonic',
+                        return_value=start + meta.flush_interval):
+            meta.update_meta('subj B', 'second')
+        text = self.read()
+        self.assertIn('subj A\n  first\n', text)
+        self.assertIn('subj B\n  second\n', text)
+
+    def test_no_changes(self) -> None:
+        meta = Meta(self.fname)
+        meta.update_meta('subj A', 'old comment')
+        meta.flush()
+        self.assertEqual(self.read(), META)
+
+    def test_alias(self) -> None:
+        meta = Meta(self.fname)
+        meta.update_meta('subj C old', 'by alias')
+        meta.flush()
+        self.assertIn('subj C\n  by alias\n=subj C old\n', self.read())
+        self.assertEqual(Meta(self.fname).get_comment('subj C'), 'by alias')
+
+    def test_new_subject(self) -> None:
+        meta = Meta(self.fname)
+        meta.update_meta('subj D', 'new', ('h1', 'h2'))
+        meta.flush()
+        self.assertEqual(self.read(), META + '\nsubj D\n  new\n  ok: h1 h2\n')
+
+    def test_concurrent_modification(self) -> None:
+        meta = Meta(self.fname)
+        meta.update_meta('subj A', 'ours')
+
+        # Somebody else modifies the file while we keep our update in memory
+        with open(self.fname, 'a') as f:
+            f.write('\nsubj E\n  theirs\n')
+
+        meta.update_meta('subj B', 'ours too')
+        meta.flush()
+        text = self.read()
+        self.assertIn('subj A\n  ours\n', text)
+        self.assertIn('subj B\n  ours too\n', text)
+        self.assertIn('subj E\n  theirs\n', text)
+
+        reread = Meta(self.fname)
+        self.assertEqual(reread.get_comment('subj A'), 'ours')
+        self.assertEqual(reread.get_comment('subj E'), 'theirs')
+
+    def test_exit(self) -> None:
+        script = load_script()
+        gcr = script.GitCheckRebase(
+            range_defs=[], meta_path=self.fname, html=False,
+            issue_tracker=None, porting_issues=None, legend=False,
+            columns=None, rows_hide_level=None, rows_filter=None,
+            interactive=False, export_as_branch=None, color=False,
+            ign_commit_messages=False)
+
+        with self.assertRaises(KeyboardInterrupt):
+            with gcr:
+                gcr.meta.update_meta('subj A', 'interrupted')
+                self.assertEqual(self.read(), META)
+                raise KeyboardInterrupt
+
+        self.assertIn('subj A\n  interrupted\n', self.read())
+
+
+class TestMetaSnapshot(MetaTestCase):
+    def test_same_as_parsed(self) -> None:
+        parsed = Meta(self.fname)
+        with mock.patch.object(Meta, '_parse', side_effect=AssertionError):
+            loaded = Meta(self.fname)
+
+        self.assertEqual({k: c.to_list() for k, c in loaded.by_key.items()},
+                         {k: c.to_list() for k, c in parsed.by_key.items()})
+        self.assertEqual(loaded.aliases, parsed.aliases)
+        self.assertEqual(loaded.by_key['subj F'].checked, [('h3', 'h4')])
+
+        loaded.update_meta('subj F #ABC-1234', 'comment F')
+        loaded.flush()
+        self.assertIn('subj F #ABC-1234\n  comment F\n', self.read())
+
+    def test_modified(self) -> None:
+        Meta(self.fname)
+        with open(self.fname, 'a') as f:
+            f.write('\nsubj G\n  new\n')
+
+        self.assertEqual(Meta(self.fname).get_comment('subj G'), 'new')
+
+
+class TestWriteFileAtomic(MetaTestCase):
+    def test_write(self) -> None:
+        os.chmod(self.fname, 0o640)
+        write_file_atomic(self.fname, 'new\n')
+
+        self.assertEqual(self.read(), 'new\n')
+        self.assertEqual(stat.S_IMODE(os.stat(self.fname).st_mode), 0o640)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['meta'])
+
+    def test_symlink(self) -> None:
+        link = os.path.join(self.tmp, 'link')
+        os.symlink(self.fname, link)
+        write_file_atomic(link, 'new\n')
+
+        self.assertTrue(os.path.islink(link))
+        self.assertEqual(self.read(), 'new\n')
+
+    def test_failure(self) -> None:
+        with mock.patch('os.replace', side_effect=OSError):
+            with self.assertRaises(OSError):
+                write_file_atomic(self.fname, 'new\n')
+
+        self.assertEqual(self.read(), META)
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['meta'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+import subprocess
+from typing import Iterator
+
+from git_check_rebase.compare_commits import eat_numbers, text_hash, \
+    patch_hash, iter_commit_patches, iter_fingerprints, Fingerprint
+from tests.test_rewrite_commit import RewriteTestCase, LINES, git, commit, \
+    replace
+
+
+def chunks(data: bytes, size: int) -> Iterator[bytes]:
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+class TestPatchHash(RewriteTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit('base', **{'a.txt': LINES + ['\n', 'end\n'],
+                          'b.txt': ['Date: 2020 +0000\n', 'b\n']})
+        commit('empty lines and numbers',
+               **{'a.txt': replace(LINES, line3='', line7='index 7') +
+                  ['\n', '\n', 'commit 1\n', '@@ -1 +1 @@\n'],
+                  'b.txt': ['\n', 'Date: 2021 +0000\n', 'b\n']})
+        commit('crlf, no newline at end, not ascii',
+               **{'a.txt': ['crlf\r\n', '\r\n', 'ünïcode\n', 'last'],
+                  'c.txt': ['From me\n', '+\n', '-\n']})
+        git('commit', '-q', '--allow-empty', '-m', 'empty')
+
+        git('checkout', '-q', '-b', 'side', 'master~2')
+        commit('side', **{'a.txt': replace(LINES, line3='side')})
+        git('checkout', '-q', 'master')
+        # Conflict, resolved by the next commit
+        subprocess.run(['git', 'merge', '-q', 'side'],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        commit('merge', **{'a.txt': ['resolved\n']})
+
+        self.commits = git('rev-list', '--all').split()
+
+    def test_same_as_eat_numbers(self) -> None:
+        patches = list(iter_commit_patches(self.commits))
+        self.assertEqual(len(patches), len(self.commits))
+
+        for full, _, _, patch in patches:
+            expected = text_hash(eat_numbers(patch))
+            data = patch.encode()
+            for size in (1, 2, 3, 7, 64, len(data) or 1):
+                with self.subTest(commit=full, size=size):
+                    self.assertEqual(patch_hash(chunks(data, size)),
+                                     expected)
+
+    def test_fingerprints(self) -> None:
+        fingerprints = list(iter_fingerprints(self.commits))
+
+        self.assertEqual(
+            fingerprints,
+            [(full, Fingerprint(patch=text_hash(eat_numbers(patch)),
+                                message=text_hash(message.strip())))
+             for full, _, message, patch
+             in iter_commit_patches(self.commits)])
+        self.assertIn(text_hash(''), [fp.patch for _, fp in fingerprints])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import unittest
+import subprocess
+from tempfile import mkdtemp
+from typing import Any, List, Optional
+
+from benchmarks.gen_repo import RepoShape, generate
+from git_check_rebase import simple_git
+from git_check_rebase.compare_commits import get_cache
+from git_check_rebase.compare_ranges import MultiRange, Table
+
+IDENT = {'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+         'GIT_COMMITTER_NAME': 'Test',
+         'GIT_COMMITTER_EMAIL': 'test@example.com'}
+
+
+def git(*args: str, input: Optional[str] = None) -> str:
+    return subprocess.run(['git', *args], check=True, input=input,
+                          stdout=subprocess.PIPE, encoding='utf-8',
+                          env=dict(os.environ, **IDENT)).stdout.strip()
+
+
+def rewrite(branch: str, base: str, drop: Optional[int] = None,
+            reword: Optional[int] = None) -> None:
+    """Recreate commits of @base..@branch, dropping commit number @drop
+    and changing message of commit number @reword
+    """
+    parent = git('rev-parse', base)
+    commits = git('rev-list', '--reverse', f'{base}..{branch}').split()
+    for i, c in enumerate(commits):
+        if i == drop:
+            continue
+        message = git('log', '-1', '--format=%B', c)
+        if i == reword:
+            message += '\n\nReviewed-by: Test <test@example.com>'
+        parent = git('commit-tree', c + '^{tree}', '-p', parent,
+                     input=message + '\n')
+    git('update-ref', 'refs/heads/' + branch, parent)
+
+
+def snapshot(tab: Table) -> List[Any]:
+    return [tab.corresponding] + \
+        [(row.subject, [None if c is None else
+                        (c.commit_hash, c.in_tag, c.proposed, c.comp)
+                        for c in row.commits])
+         for row in tab.rows]
+
+
+class TestUpdateRange(unittest.TestCase):
+    """Table.update_range() must give the same table as built from
+    scratch
+    """
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.tmp = mkdtemp(prefix='gcr-test-')
+        cls.cwd = os.getcwd()
+        cls.old_cache_dir = os.environ.get('GIT_CHECK_REBASE_CACHE_DIR')
+        os.environ['GIT_CHECK_REBASE_CACHE_DIR'] = \
+            os.path.join(cls.tmp, 'cache')
+
+        repo = os.path.join(cls.tmp, 'repo')
+        generate(repo, RepoShape(commits=30, ranges=3, equal_share=0.5,
+                                 renamed_share=0.3, issues=0))
+        os.chdir(repo)
+        cls.reset_git_state()
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        get_cache().flush()
+        cls.reset_git_state()
+        os.chdir(cls.cwd)
+        if cls.old_cache_dir is None:
+            del os.environ['GIT_CHECK_REBASE_CACHE_DIR']
+        else:
+            os.environ['GIT_CHECK_REBASE_CACHE_DIR'] = cls.old_cache_dir
+        shutil.rmtree(cls.tmp)
+
+    @staticmethod
+    def reset_git_state() -> None:
+        """Forget caches and processes, bound to the current repository"""
+        simple_git.CAT_FILE.close()
+        simple_git.CAT_FILE_CHECK.close()
+        simple_git.git_get_cache_dir.cache_clear()
+        simple_git.git_commit_tags.cache_clear()
+        get_cache.cache_clear()
+
+    def check_update(self, r_ind: int, **rewrite_args: Any) -> None:
+        branch = f'work-{self.id().rsplit(".", 1)[-1]}'
+        git('branch', branch, f'v{r_ind}')
+        defs = [f'upstream-v{k}..' + (branch if k == r_ind else f'v{k}')
+                for k in range(3)]
+
+        tab = Table([MultiRange(d) for d in defs])
+        tab.do_comparison(False)
+
+        rewrite(branch, f'upstream-v{r_ind}', **rewrite_args)
+        tab.update_range(r_ind, MultiRange(defs[r_ind]), False)
+
+        full = Table([MultiRange(d) for d in defs])
+        full.do_comparison(False)
+
+        self.assertEqual(snapshot(tab), snapshot(full))
+
+    def test_reword_last(self) -> None:
+        self.check_update(2, reword=5)
+
+    def test_drop_last(self) -> None:
+        # Ranges stop being corresponding to the last one, positional
+        # matches of kept rows must go away
+        self.check_update(2, drop=25)
+
+    def test_reword_other(self) -> None:
+        self.check_update(1, reword=3)
+
+    def test_drop_other(self) -> None:
+        self.check_update(0, drop=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
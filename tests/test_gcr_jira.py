@@ -0,0 +1,247 @@
+import re
+import sys
+import types
+import unittest
+import importlib
+from unittest import mock
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+
+from git_check_rebase.parse_issues import parse_issues
+
+EPIC_LINK = 'customfield_10008'
+
+# Issues in order of rank: key => (type, parent or epic, subtasks,
+# description)
+ISSUES: Dict[str, Tuple[str, Optional[str], List[str], str]] = {
+    'EPIC-1': ('Epic', None, [], 'Port: subj A\n'),
+    'TASK-2': ('Task', 'EPIC-1', [], 'Port: subj A\n'),
+    'TASK-1': ('Task', 'EPIC-1', ['SUB-2', 'SUB-1'], 'Port: subj B\n'),
+    'SUB-1': ('Sub-task', 'TASK-1', [], 'Port: subj C\n'),
+    'SUB-2': ('Sub-task', 'TASK-1', [], 'Port: subj A\n'),
+    'TASK-3': ('Task', None, ['SUB-3'], 'Port: subj D\n'),
+    'SUB-3': ('Sub-task', 'TASK-3', [], 'Port: subj A\n'),
+}
+
+SUBJECTS = ['subj A', 'subj B', 'subj C', 'subj D']
+
+JQL_RE = re.compile(
+    r'(key|parent|"Epic Link") in \(([^)]*)\)( ORDER BY Rank)?')
+
+
+class ResultList(list):
+    """Like jira.client.ResultList: page of search results"""
+    def __init__(self, issues: List[Any], total: int) -> None:
+        super().__init__(issues)
+        self.total = total
+
+
+class FakeJira:
+    """Stub of jira.JIRA client, serving ISSUES
+
+    If @epic_link is False, there is no "Epic Link" field (like in
+    team-managed projects), and issues are linked to their epic by parent
+    field. Pages of search results have at most @max_results issues.
+    """
+    server_url = 'https://jira.example.com'
+
+    def __init__(self, epic_link: bool = True,
+                 max_results: int = 1000) -> None:
+        self.epic_link = epic_link
+        self.max_results = max_results
+        # Added to real total in search results
+        self.extra_total = 0
+        self.searches: List[Tuple[str, int, int, str]] = []
+        self._session = SimpleNamespace(get=self._get)
+
+    def _make(self, key: str) -> Any:
+        issue_type, link, subtasks, description = ISSUES[key]
+        fields = SimpleNamespace(
+            description=description,
+            subtasks=[SimpleNamespace(key=k) for k in subtasks],
+            priority=SimpleNamespace(name='Major'), resolution=None,
+            issuetype=SimpleNamespace(name=issue_type),
+            updated='2020-01-01T00:00:00.000+0000')
+        if link is not None:
+            if ISSUES[link][0] == 'Epic' and self.epic_link:
+                setattr(fields, EPIC_LINK, link)
+            else:
+                fields.parent = SimpleNamespace(key=link)
+        return SimpleNamespace(key=key, fields=fields)
+
+    def _link(self, key: str, field: str) -> Optional[str]:
+        issue = self._make(key)
+        if field == 'parent':
+            return getattr(getattr(issue.fields, 'parent', None), 'key', None)
+        return getattr(issue.fields, EPIC_LINK, None)
+
+    def fields(self) -> List[Dict[str, str]]:
+        res = [{'id': 'summary', 'name': 'Summary'}]
+        if self.epic_link:
+            res.append({'id': EPIC_LINK, 'name': 'Epic Link'})
+        return res
+
+    def issue(self, key: str, fields: str) -> Any:
+        return self._make(key)
+
+    def search_issues(self, jql: str, startAt: int, maxResults: int,
+                      fields: str) -> ResultList:
+        self.searches.append((jql, startAt, maxResults, fields))
+        m = JQL_RE.fullmatch(jql)
+        assert m, jql
+        field, keys, by_rank = m.group(1), m.group(2).split(', '), m.group(3)
+
+        if field == 'key':
+            found = [k for k in keys if k in ISSUES]
+        else:
+            found = [k for k in ISSUES if self._link(k, field) in keys]
+            if not by_rank:
+                found.sort()
+
+        page = found[startAt:startAt + min(maxResults, self.max_results)]
+        return ResultList([self._make(k) for k in page],
+                          len(found) + self.extra_total)
+
+    def _get(self, url: str) -> Dict[str, Any]:
+        m = re.fullmatch(self.server_url + r'/rest/agile/1.0/epic/(.*)/issue',
+                         url)
+        assert m, url
+        epic = m.group(1)
+        return {'issues': [{'key': k} for k in ISSUES
+                           if self._link(k, 'parent') == epic or
+                           self._link(k, '"Epic Link"') == epic]}
+
+
+def import_gcr_jira() -> Any:
+    """Import gcr_jira with stub jira module, it is not needed as the
+    client is replaced by FakeJira anyway
+    """
+    stub = types.ModuleType('jira')
+    stub.utils = types.ModuleType('jira.utils')
+    stub.utils.json_loads = lambda response: response
+    with mock.patch.dict(sys.modules, {'jira': stub,
+                                       'jira.utils': stub.utils}):
+        sys.modules.pop('git_check_rebase.gcr_jira', None)
+        return importlib.import_module('git_check_rebase.gcr_jira')
+
+
+gcr_jira = import_gcr_jira()
+
+
+class PerIssueTracker:
+    """Hides bulk methods of the tracker, so that issues are loaded one by
+    one
+    """
+    def __init__(self, tracker: Any) -> None:
+        self.get_issue = tracker.get_issue
+
+
+class TestGCRTracer(unittest.TestCase):
+    def tracker(self, **jira_args: Any) -> Any:
+        tracker = gcr_jira.GCRTracer.__new__(gcr_jira.GCRTracer)
+        tracker._jira = FakeJira(**jira_args)
+        return tracker
+
+    def searches(self, tracker: Any) -> List[Tuple[str, int, int, str]]:
+        res = tracker._jira.searches
+        tracker._jira.searches = []
+        return res
+
+    def test_get_issues(self) -> None:
+        tracker = self.tracker()
+        tracker.keys_per_query = 2
+        keys = ['TASK-1', 'TASK-2', 'TASK-3', 'SUB-1', 'SUB-2']
+
+        self.assertEqual([i.key for i in tracker.get_issues(keys)], keys)
+        self.assertEqual([(jql, fields) for jql, _, _, fields
+                          in self.searches(tracker)],
+                         [('key in (TASK-1, TASK-2)', gcr_jira.FIELDS),
+                          ('key in (TASK-3, SUB-1)', gcr_jira.FIELDS),
+                          ('key in (SUB-2)', gcr_jira.FIELDS)])
+
+    def test_pagination(self) -> None:
+        keys = list(ISSUES)
+        for max_results, starts in ((1000, [0, 2, 4, 6]),
+                                    (1, list(range(len(keys))))):
+            with self.subTest(max_results=max_results):
+                # Server may return less issues than requested, total
+                # tells when to stop
+                tracker = self.tracker(max_results=max_results)
+                tracker.page_size = 2
+
+                self.assertEqual([i.key for i in tracker.get_issues(keys)],
+                                 keys)
+                self.assertEqual([start for _, start, _, _
+                                  in self.searches(tracker)], starts)
+
+    def test_pagination_empty_page(self) -> None:
+        # Total is larger than number of found issues (some are deleted
+        # meanwhile), search stops at empty page
+        tracker = self.tracker()
+        tracker._jira.extra_total = 1
+        tracker.page_size = 4
+
+        self.assertEqual([i.key for i in tracker.get_issues(list(ISSUES))],
+                         list(ISSUES))
+        self.assertEqual([start for _, start, _, _ in self.searches(tracker)],
+                         [0, 4, 7])
+
+    def check_subissues_bulk(self, tracker: Any) -> None:
+        issues = tracker.get_issues(['EPIC-1', 'TASK-1', 'TASK-3', 'SUB-1'])
+        self.searches(tracker)
+
+        res = tracker.get_subissues_bulk(issues)
+        self.assertEqual({key: [i.key for i in subs]
+                          for key, subs in res.items()},
+                         {'EPIC-1': ['TASK-2', 'TASK-1'],
+                          'TASK-1': ['SUB-2', 'SUB-1'],
+                          'TASK-3': ['SUB-3'], 'SUB-1': []})
+
+    def test_subissues_bulk(self) -> None:
+        tracker = self.tracker()
+        self.check_subissues_bulk(tracker)
+        self.assertEqual(
+            [(jql, fields) for jql, _, _, fields in self.searches(tracker)],
+            [('"Epic Link" in (EPIC-1) ORDER BY Rank',
+              gcr_jira.FIELDS + ',' + EPIC_LINK),
+             ('parent in (TASK-1, TASK-3, SUB-1) ORDER BY Rank',
+              gcr_jira.FIELDS + ',parent')])
+
+    def test_subissues_bulk_no_epic_link(self) -> None:
+        # Issues of epics are found by parent field
+        tracker = self.tracker(epic_link=False)
+        self.check_subissues_bulk(tracker)
+        self.assertEqual(
+            [(jql, fields) for jql, _, _, fields in self.searches(tracker)],
+            [('parent in (EPIC-1, TASK-1, TASK-3, SUB-1) ORDER BY Rank',
+              gcr_jira.FIELDS + ',parent')])
+
+    def test_same_as_per_issue(self) -> None:
+        for epic_link in (True, False):
+            with self.subTest(epic_link=epic_link):
+                tracker = self.tracker(epic_link=epic_link)
+                tracker.keys_per_query = 2
+                bulk = parse_issues(tracker, ['EPIC-1', 'TASK-3'], SUBJECTS)
+                # Search per level of the tree and per chunk of keys
+                self.assertEqual(len(self.searches(tracker)),
+                                 5 if epic_link else 4)
+
+                per_issue = parse_issues(PerIssueTracker(tracker),
+                                         ['EPIC-1', 'TASK-3'], SUBJECTS)
+                self.assertEqual(
+                    {s: [i.key for i in issues]
+                     for s, issues in bulk.items()},
+                    {s: [i.key for i in issues]
+                     for s, issues in per_issue.items()})
+                self.assertEqual([i.key for i in bulk['subj A']],
+                                 ['EPIC-1', 'TASK-2', 'SUB-2', 'SUB-3'])
+
+    def test_issue_updated(self) -> None:
+        tracker = self.tracker()
+        self.assertIsNone(tracker.get_issue_updated('EPIC-1'))
+        self.assertEqual(tracker.get_issue_updated('TASK-1'),
+                         '2020-01-01T00:00:00.000+0000')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import shutil
+import random
+import unittest
+from unittest import mock
+from tempfile import mkdtemp
+from typing import Any, Dict, List
+
+from benchmarks.fake_tracker import FakeTracker, FakeBulkTracker, FakeIssue
+from git_check_rebase.parse_issues import load_issues, parse_issues
+from git_check_rebase.issue_cache import IssueCache, CachingTracker
+
+SUBJECTS = ['subj A', 'subj B', 'subj C', 'subj D']
+
+# TEST-4 is a subissue of both TEST-2 and TEST-3
+ISSUES = {
+    'TEST-1': ['subj A'], 'TEST-2': ['subj B', 'subj A'],
+    'TEST-3': ['subj A'], 'TEST-4': ['subj C'], 'TEST-5': ['subj A'],
+}
+SUBISSUES = {
+    'TEST-1': ['TEST-2', 'TEST-3'], 'TEST-2': ['TEST-4'],
+    'TEST-3': ['TEST-4', 'TEST-5'],
+}
+
+# Issues in depth-first order: TEST-1, TEST-2, TEST-4, TEST-3, TEST-5
+EXPECTED = {
+    'subj A': ['TEST-1', 'TEST-2', 'TEST-3', 'TEST-5'],
+    'subj B': ['TEST-2'],
+    'subj C': ['TEST-4'],
+}
+
+
+def issues_json(issues: Dict[str, List[str]],
+                subissues: Dict[str, List[str]]) -> Dict[str, Any]:
+    return {key: {'description': ''.join(f'Port: {s}\n' for s in subjects),
+                  'subissues': subissues.get(key, []),
+                  'updated': '2020-01-01T00:00:00',
+                  'critical': False}
+            for key, subjects in issues.items()}
+
+
+class ShuffledTracker(FakeTracker):
+    """Requests take random time, so they complete in random order"""
+    def __init__(self) -> None:
+        super().__init__()
+        self.loaded: List[str] = []
+
+    def get_issue(self, key: str) -> FakeIssue:
+        time.sleep(random.random() / 100)
+        self.loaded.append(key)
+        return super().get_issue(key)
+
+
+class IssuesTestCase(unittest.TestCase):
+    """Base class, which sets up issues of fake tracker"""
+    issues = issues_json(ISSUES, SUBISSUES)
+
+    def setUp(self) -> None:
+        self.tmp = mkdtemp(prefix='gcr-test-')
+        self.issues_file = os.path.join(self.tmp, 'issues.json')
+        self.write_issues(self.issues)
+
+        env = mock.patch.dict(os.environ,
+                              GCR_BENCH_ISSUES=self.issues_file,
+                              GCR_BENCH_TRACKER_LATENCY='0')
+        env.start()
+        self.addCleanup(env.stop)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp)
+
+    def write_issues(self, issues: Dict[str, Any]) -> None:
+        with open(self.issues_file, 'w') as f:
+            json.dump(issues, f)
+
+    def assertResult(self, result: Dict[str, List[Any]],
+                     expected: Dict[str, List[str]]) -> None:
+        self.assertEqual({subj: [issue.key for issue in issues]
+                          for subj, issues in result.items()}, expected)
+
+
+class TestLoadIssues(IssuesTestCase):
+    def test_order(self) -> None:
+        # Result doesn't depend on order of loading
+        for jobs in (1, 8):
+            with self.subTest(jobs=jobs):
+                tracker = ShuffledTracker()
+                self.assertResult(
+                    parse_issues(tracker, ['TEST-1'], SUBJECTS, jobs),
+                    EXPECTED)
+                # Each issue is requested once, TEST-4 too
+                self.assertEqual(sorted(tracker.loaded), sorted(ISSUES))
+
+    def test_parents_first(self) -> None:
+        tracker = ShuffledTracker()
+        load_issues(tracker, ['TEST-1'], 8)
+        order = {key: i for i, key in enumerate(tracker.loaded)}
+        # Subissue is loaded after (the first loaded of) its parents
+        parents: Dict[str, List[int]] = {}
+        for key, subissues in SUBISSUES.items():
+            for sub in subissues:
+                parents.setdefault(sub, []).append(order[key])
+        for sub, parent_order in parents.items():
+            self.assertLess(min(parent_order), order[sub])
+
+    def test_error(self) -> None:
+        self.write_issues(issues_json(
+            ISSUES, dict(SUBISSUES, **{'TEST-5': ['MISSING-1']})))
+        for jobs in (1, 8):
+            with self.subTest(jobs=jobs):
+                with self.assertRaises(KeyError):
+                    load_issues(ShuffledTracker(), ['TEST-1'], jobs)
+
+    def test_bulk(self) -> None:
+        tracker = FakeBulkTracker()
+        self.assertResult(parse_issues(tracker, ['TEST-1'], SUBJECTS),
+                          EXPECTED)
+        # Root issue and one bulk request per level of the tree
+        self.assertEqual(tracker.requests, 4)
+
+
+class CountingTracker(FakeTracker):
+    """Counts loads and revalidations of issues separately"""
+    def __init__(self) -> None:
+        super().__init__()
+        self.loads = 0
+        self.checks = 0
+
+    def get_issue(self, key: str) -> FakeIssue:
+        self.loads += 1
+        return super().get_issue(key)
+
+    def get_issue_updated(self, key: str) -> str:
+        self.checks += 1
+        return super().get_issue_updated(key)
+
+
+class CountingBulkTracker(FakeBulkTracker):
+    pass
+
+
+class TestIssueCache(IssuesTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.cache = IssueCache(os.path.join(self.tmp, 'issue-cache.db'),
+                                'fake')
+
+    def caching(self, tracker_class: type = CountingTracker,
+                ttl: float = 3600, offline: bool = False,
+                jobs: int = 4) -> CachingTracker:
+        return CachingTracker(lambda: tracker_class, self.cache, ttl,
+                              offline, jobs)
+
+    def parse(self, tracker: CachingTracker) -> Dict[str, List[Any]]:
+        return parse_issues(tracker, ['TEST-1'], SUBJECTS, tracker.jobs)
+
+    def test_bulk_methods(self) -> None:
+        self.assertFalse(hasattr(self.caching(), 'get_subissues_bulk'))
+        self.assertTrue(hasattr(self.caching(CountingBulkTracker),
+                                'get_subissues_bulk'))
+        self.assertFalse(hasattr(self.caching(CountingBulkTracker,
+                                              offline=True),
+                                 'get_subissues_bulk'))
+
+    def test_ttl(self) -> None:
+        tracker = self.caching()
+        self.assertResult(self.parse(tracker), EXPECTED)
+        self.assertEqual(tracker.tracker.loads, len(ISSUES))
+
+        # Fresh cache: tracker is not even created
+        tracker = self.caching()
+        self.assertResult(self.parse(tracker), EXPECTED)
+        self.assertIsNone(tracker._tracker)
+
+    def test_revalidate(self) -> None:
+        self.parse(self.caching())
+
+        issues = issues_json(dict(ISSUES, **{'TEST-5': ['subj D']}),
+                             SUBISSUES)
+        issues['TEST-5']['updated'] = '2020-01-02T00:00:00'
+        self.write_issues(issues)
+
+        # Expired cache: all issues are revalidated, only the updated one
+        # is loaded again
+        tracker = self.caching(ttl=0)
+        self.assertResult(self.parse(tracker), {
+            'subj A': ['TEST-1', 'TEST-2', 'TEST-3'],
+            'subj B': ['TEST-2'],
+            'subj C': ['TEST-4'],
+            'subj D': ['TEST-5'],
+        })
+        self.assertEqual(tracker.tracker.checks, len(ISSUES))
+        self.assertEqual(tracker.tracker.loads, 1)
+
+    def test_bulk(self) -> None:
+        tracker = self.caching(CountingBulkTracker)
+        self.assertResult(self.parse(tracker), EXPECTED)
+        # Root issue and one bulk request per level of the tree
+        self.assertEqual(tracker.tracker.requests, 4)
+
+        tracker = self.caching(CountingBulkTracker)
+        self.assertResult(self.parse(tracker), EXPECTED)
+        self.assertIsNone(tracker._tracker)
+
+    def test_offline(self) -> None:
+        self.parse(self.caching())
+
+        def fail() -> type:
+            raise AssertionError('tracker is loaded in offline mode')
+
+        tracker = CachingTracker(fail, self.cache, 0, True)
+        self.assertResult(self.parse(tracker), EXPECTED)
+
+        with self.assertRaises(SystemExit):
+            parse_issues(tracker, ['TEST-6'], SUBJECTS)
+
+
+if __name__ == '__main__':
+    unittest.main()
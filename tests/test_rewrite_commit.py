@@ -0,0 +1,189 @@
+import os
+import shutil
+import unittest
+import subprocess
+from unittest import mock
+from tempfile import mkdtemp
+from typing import List, Optional
+
+from git_check_rebase import simple_git
+from git_check_rebase.rewrite_commit import rewrite_commit, RewriteError
+from git_check_rebase.stats import STATS
+
+IDENT = {'GIT_AUTHOR_NAME': 'Test', 'GIT_AUTHOR_EMAIL': 'test@example.com',
+         'GIT_COMMITTER_NAME': 'Test',
+         'GIT_COMMITTER_EMAIL': 'test@example.com'}
+
+LINES = [f'line {i}\n' for i in range(1, 11)]
+
+
+def git(*args: str, input: Optional[str] = None) -> str:
+    return subprocess.run(['git', *args], check=True, input=input,
+                          stdout=subprocess.PIPE,
+                          encoding='utf-8').stdout.strip()
+
+
+def commit(message: str, **files: List[str]) -> str:
+    for name, lines in files.items():
+        with open(name, 'w') as f:
+            f.writelines(lines)
+    git('add', *files)
+    git('commit', '-q', '-m', message)
+    return git('rev-parse', 'HEAD')
+
+
+def replace(lines: List[str], **changes: str) -> List[str]:
+    """Replace lines, given as line<N>='new text'"""
+    res = list(lines)
+    for name, text in changes.items():
+        res[int(name[4:]) - 1] = text + '\n'
+    return res
+
+
+class RewriteTestCase(unittest.TestCase):
+    """Base class, which creates an empty repository with master branch"""
+    def setUp(self) -> None:
+        self.tmp = mkdtemp(prefix='gcr-test-')
+        self.cwd = os.getcwd()
+        env = mock.patch.dict(os.environ, IDENT)
+        env.start()
+        self.addCleanup(env.stop)
+
+        os.chdir(self.tmp)
+        git('init', '-q', '-b', 'master')
+        self.reset_git_state()
+
+    def tearDown(self) -> None:
+        self.reset_git_state()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    @staticmethod
+    def reset_git_state() -> None:
+        """Forget processes, bound to the current repository"""
+        simple_git.CAT_FILE.close()
+        simple_git.CAT_FILE_CHECK.close()
+
+    def email(self, rev: str, old: str, new: str) -> str:
+        """Patch of @rev in email format with @old text replaced by @new"""
+        patch = git('show', '--format=email', rev) + '\n'
+        self.assertIn(old, patch)
+        return patch.replace(old, new)
+
+
+class TestRewriteCommit(RewriteTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        commit('base', **{'a.txt': LINES, 'b.txt': LINES})
+        a1 = replace(LINES, line2='two', line9='nine')
+        self.c1 = commit('change a', **{'a.txt': a1})
+        commit('add c', **{'c.txt': ['c\n']})
+        commit('change a again', **{'a.txt': replace(a1, line2='TWO')})
+        commit('change b', **{'b.txt': replace(LINES, line5='five')})
+        self.top = git('rev-parse', 'master')
+        self.reflog = git('reflog', 'master')
+
+    def rebased_tree(self, email: str) -> str:
+        """Tree of the branch, rewritten by git am and git rebase"""
+        git('checkout', '-q', '-b', 'expected', self.c1 + '^')
+        git('am', '-q', input=email)
+        git('branch', 'expected-top', self.top)
+        git('rebase', '-q', '--onto', 'expected', self.c1, 'expected-top')
+        tree = git('rev-parse', 'expected-top^{tree}')
+        git('checkout', '-q', 'master')
+        return tree
+
+    def test_same_as_rebase(self) -> None:
+        email = self.email(self.c1, '+nine', '+NINE')
+        expected = self.rebased_tree(email)
+
+        new = rewrite_commit(self.c1, 'master', email)
+
+        self.assertEqual(git('rev-parse', 'master^{tree}'), expected)
+        self.assertEqual(git('rev-parse', 'master~3'), new)
+        self.assertEqual(git('log', '--format=%s', 'master'),
+                         git('log', '--format=%s', self.top))
+        self.assertEqual(git('log', '-1', '--format=%an <%ae>', new),
+                         'Test <test@example.com>')
+
+    def test_working_tree_and_reflog(self) -> None:
+        new = rewrite_commit(self.c1, 'master',
+                             self.email(self.c1, '+nine', '+NINE'))
+
+        self.assertEqual(git('status', '--porcelain'), '')
+        with open('a.txt') as f:
+            self.assertEqual(f.readlines(),
+                             replace(LINES, line2='TWO', line9='NINE'))
+        self.assertEqual(git('reflog', '-1', '--format=%gs', 'master'),
+                         f'check-rebase: rewrite {self.c1[:12]}')
+        self.assertEqual(git('rev-parse', 'master@{1}'), self.top)
+        self.assertNotEqual(new, self.c1)
+
+    def test_stats(self) -> None:
+        with mock.patch.object(STATS, 'enabled', True), \
+                mock.patch.object(STATS, 'git', {}):
+            rewrite_commit(self.c1, 'master',
+                           self.email(self.c1, '+nine', '+NINE'))
+            self.assertEqual(STATS.git['merge-file'][0], 1)
+            self.assertEqual(STATS.git['fast-import'][0], 1)
+
+    def test_conflict(self) -> None:
+        # Next "change a again" commit changes the same line
+        email = self.email(self.c1, '+two', '+deux')
+
+        with self.assertRaises(RewriteError) as ctx:
+            rewrite_commit(self.c1, 'master', email)
+
+        self.assertIn('conflict in a.txt', str(ctx.exception))
+        self.assertTrue(ctx.exception.retry)
+        self.assertEqual(git('rev-parse', 'master'), self.top)
+        self.assertEqual(git('reflog', 'master'), self.reflog)
+        self.assertEqual(git('status', '--porcelain'), '')
+        self.assertEqual(git('for-each-ref', 'refs/check-rebase'), '')
+
+    def test_bad_patch(self) -> None:
+        email = self.email(self.c1, '-line 9', '-no such line')
+
+        with self.assertRaises(RewriteError):
+            rewrite_commit(self.c1, 'master', email)
+
+        self.assertEqual(git('rev-parse', 'master'), self.top)
+        self.assertEqual(git('status', '--porcelain'), '')
+
+
+class TestLongChain(RewriteTestCase):
+    """Output of diff-tree for the chain is much larger than pipe buffer"""
+    commits = 3000
+
+    def setUp(self) -> None:
+        super().setUp()
+        stream = []
+        for i in range(self.commits):
+            ident = f'Test <test@example.com> {1577836800 + i} +0000'
+            message = f'commit {i}'
+            content = f'file {i}\n'
+            stream.append(f'commit refs/heads/master\n'
+                          f'author {ident}\ncommitter {ident}\n'
+                          f'data {len(message)}\n{message}\n'
+                          f'M 100644 inline f{i}.txt\n'
+                          f'data {len(content)}\n{content}\n')
+        subprocess.run(['git', 'fast-import', '--quiet'], check=True,
+                       input=''.join(stream), encoding='utf-8')
+        git('checkout', '-q', 'master')
+
+    def test_rewrite_first(self) -> None:
+        top = git('rev-parse', 'master')
+        first = git('rev-list', '--max-parents=0', 'master')
+
+        rewrite_commit(first, 'master',
+                       self.email(first, '+file 0', '+file zero'))
+
+        self.assertEqual(git('diff', '--name-only', top, 'master'),
+                         'f0.txt')
+        self.assertEqual(git('rev-list', '--count', 'master'),
+                         str(self.commits))
+        self.assertEqual(git('status', '--porcelain'), '')
+
+
+if __name__ == '__main__':
+    unittest.main()